@@ -0,0 +1,166 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Data parallel (DDP over gloo) CPU training throughput at 1/2/4/8 workers.
+
+Each level trains the same tiny local model on the same synthetic data, then evaluates
+it with the distributed Predictor, so accuracies should match across levels within
+tolerance.
+
+    python -m benchmarks.ddp_scaling --workers 1 2 4 8
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import torch
+from datasets import Dataset
+from transformers import (
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    Trainer,
+    TrainingArguments,
+)
+
+from gvr.configs import Config
+from gvr.distributed import init_from_env, is_main_process, world_size
+from gvr.inference import Predictor
+
+from .tiny_models import build_tiny_model
+from .training_profiles import synthetic_texts
+
+BATCH_SIZE = 32
+
+
+def labeled_data(n: int, seed: int) -> Dataset:
+    texts = synthetic_texts(n, seed)
+    # Learnable synthetic task: does the text contain "the" more often than "of"
+    labels = [int(t.split().count("the") > t.split().count("of")) for t in texts]
+    return Dataset.from_dict({"text": texts, "label": labels})
+
+
+def worker(args: argparse.Namespace) -> None:
+    Config.device = torch.device("cpu")
+    init_from_env()
+    torch.manual_seed(Config.SEED)
+
+    tokenizer = AutoTokenizer.from_pretrained(str(args.model_path))
+    model = AutoModelForSequenceClassification.from_pretrained(str(args.model_path))
+    model.config.id2label = {0: "0", 1: "1"}
+    model.config.label2id = {"0": 0, "1": 1}
+
+    train = labeled_data(args.samples, seed=1).map(
+        lambda x: tokenizer(x["text"], truncation=True), batched=True
+    )
+    training_args = TrainingArguments(
+        output_dir=str(args.output.parent / f"run-{world_size()}"),
+        per_device_train_batch_size=math.ceil(BATCH_SIZE / world_size()),
+        num_train_epochs=args.epochs,
+        learning_rate=1e-3,
+        seed=Config.SEED,
+        save_strategy="no",
+        report_to=[],
+        disable_tqdm=True,
+        no_cuda=True,
+        xpu_backend="gloo" if world_size() > 1 else None,
+    )
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=train.remove_columns("text"),
+        data_collator=DataCollatorWithPadding(tokenizer=tokenizer),
+    )
+    metrics = trainer.train().metrics
+    trainer.save_model()
+
+    predictor = Predictor(
+        training_args.output_dir, device=torch.device("cpu"), cache=False
+    )
+    test = labeled_data(args.samples // 4, seed=2)
+    labels, _ = predictor.predict(test["text"])
+    accuracy = sum(int(p) == t for p, t in zip(labels, test["label"])) / len(test)
+
+    if is_main_process():
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "workers": world_size(),
+                    "train_samples_per_second": metrics["train_samples_per_second"],
+                    "train_runtime": metrics["train_runtime"],
+                    "accuracy": accuracy,
+                },
+                f,
+            )
+
+
+def main(args: argparse.Namespace) -> None:
+    cores = len(os.sched_getaffinity(0))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = build_tiny_model(
+            args.model, synthetic_texts(args.samples), Path(tmp) / "model"
+        )
+        for workers in args.workers:
+            output = Path(tmp) / f"{workers}.json"
+            env = {**os.environ, "OMP_NUM_THREADS": str(max(1, cores // workers))}
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "torch.distributed.run",
+                    "--standalone",
+                    f"--nproc_per_node={workers}",
+                    "-m",
+                    "benchmarks.ddp_scaling",
+                    "--worker",
+                    f"--model-path={model_path}",
+                    f"--output={output}",
+                    f"--samples={args.samples}",
+                    f"--epochs={args.epochs}",
+                ],
+                env=env,
+                check=True,
+            )
+            with open(output, "r") as f:
+                results.append(json.load(f))
+            print(json.dumps(results[-1]))
+
+    baseline = results[0]
+    for result in results:
+        result["speedup"] = (
+            result["train_samples_per_second"] / baseline["train_samples_per_second"]
+        )
+        result["accuracy_delta"] = result["accuracy"] - baseline["accuracy"]
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="xlm-roberta-base")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--samples", type=int, default=2048)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--model-path", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--output", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    worker(args) if args.worker else main(args)
@@ -0,0 +1,61 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Reports cold (store rebuilt from TSV) and warm (memory-mapped store) load times.
+
+Run from the repository root, with the AuTexTification data in data/:
+
+    python -m benchmarks.load_data
+"""
+
+import json
+import time
+from itertools import product
+from pathlib import Path
+
+from gvr.data import load_data
+
+
+def main() -> None:
+    timings = []
+    for subtask, language, split in product([1, 2], ["en", "es"], ["train", "test"]):
+        path = Path.cwd() / "data" / split / f"subtask_{subtask}" / language
+        if not (path / f"{split}.tsv").exists():
+            continue
+
+        start = time.perf_counter()
+        data = load_data(subtask, language, split, refresh=True)
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        load_data(subtask, language, split)
+        warm = time.perf_counter() - start
+
+        timings.append(
+            {
+                "subtask": subtask,
+                "language": language,
+                "split": split,
+                "rows": len(data),
+                "cold_seconds": round(cold, 4),
+                "warm_seconds": round(warm, 4),
+            }
+        )
+
+    print(json.dumps(timings, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Load generator for `gvr.app serve`: measures throughput and latency against
+request concurrency.
+
+    python -m gvr.app serve --model type=checkpoints/model_family/type/en/xlm-roberta-base
+    python -m benchmarks.loadgen --model type --concurrency 1 4 16 64
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+WORDS = "the of and to in a is that for it as was with be by on not he this are".split()
+
+
+def load_texts(path: Optional[Path], n: int) -> List[str]:
+    if path is not None:
+        return pd.read_csv(path, sep="\t")["text"].astype(str).tolist()[:n]
+    rng = random.Random(0)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+        for _ in range(n)
+    ]
+
+
+async def request(
+    host: str, port: int, path: str, payload: Optional[Dict] = None
+) -> Dict:
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    method = "POST" if payload is not None else "GET"
+    writer.write(
+        (
+            f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+        ).encode("latin-1")
+        + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def run_level(
+    host: str, port: int, model: str, texts: List[str], concurrency: int
+) -> Dict:
+    queue: asyncio.Queue = asyncio.Queue()
+    for text in texts:
+        queue.put_nowait(text)
+    latencies: List[float] = []
+
+    async def client() -> None:
+        while not queue.empty():
+            text = queue.get_nowait()
+            start = time.perf_counter()
+            await request(host, port, f"/predict/{model}", {"text": text})
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed,
+        "latency_p50_ms": latencies[len(latencies) // 2] * 1000,
+        "latency_p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    texts = load_texts(args.texts, args.requests)
+    results = []
+    for concurrency in args.concurrency:
+        results.append(
+            await run_level(args.host, args.port, args.model, texts, concurrency)
+        )
+        print(json.dumps(results[-1]))
+
+    metrics = await request(args.host, args.port, "/metrics")
+    print(json.dumps({"levels": results, "server_metrics": metrics}, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", required=True, help="Name of a served detector.")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument(
+        "--texts", type=Path, default=None, help="TSV with a text column to sample."
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,171 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Packed vs unpacked training on tiny local models: throughput and accuracy.
+
+For each architecture, first checks that packed rows give the same logits as unpadded
+examples, then trains the same tiny model with and without `Config.packing` on
+synthetic data and evaluates both with `evaluate_finetuned`:
+
+    python -m benchmarks.packing --epochs 2
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+import torch
+from datasets import Dataset
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from gvr.configs import Config
+from gvr.finetune import evaluate_finetuned, finetune
+from gvr.packing import (
+    PackedClassifier,
+    PackedCollator,
+    pack_examples,
+    packed_dataset,
+    position_offset,
+)
+from gvr.profiling import collect
+
+from .suite import synthetic_split
+from .tiny_models import build_tiny_model
+
+
+def max_logit_difference(model_path: Path, texts, max_length: int) -> float:
+    """Largest difference between packed and one-by-one logits of the same model"""
+    tokenizer = AutoTokenizer.from_pretrained(str(model_path))
+    model = AutoModelForSequenceClassification.from_pretrained(str(model_path)).eval()
+    encodings = tokenizer(texts, truncation=True, max_length=max_length)
+    data = Dataset.from_dict(
+        {"input_ids": encodings["input_ids"], "label": [0] * len(texts)}
+    )
+
+    rows = pack_examples([len(x) for x in data["input_ids"]], max_length)
+    order = [idx for row in rows for idx in row]
+    batch = PackedCollator(tokenizer.pad_token_id, position_offset(model.config))(
+        list(packed_dataset(data, max_length))
+    )
+    batch.pop("labels")
+
+    with torch.inference_mode():
+        packed = PackedClassifier(model)(**batch)["logits"]
+        single = torch.cat(
+            [
+                model(input_ids=torch.tensor([data["input_ids"][idx]])).logits
+                for idx in order
+            ]
+        )
+    return float((packed - single).abs().max())
+
+
+def main(args: argparse.Namespace) -> None:
+    cwd = Path.cwd()
+    training_args = Config.training_args
+    results: Dict[str, Any] = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            Config.training_args = {
+                **training_args,
+                "num_train_epochs": args.epochs,
+                "report_to": [],
+                "disable_tqdm": True,
+            }
+            train = Dataset.from_pandas(
+                synthetic_split(1, "en", args.samples, Config.SEED),
+                preserve_index=False,
+            )
+            test = Dataset.from_pandas(
+                synthetic_split(1, "en", args.samples // 2, Config.SEED + 1),
+                preserve_index=False,
+            )
+            label2id = {"generated": 0, "human": 1}
+
+            for model_name in args.models:
+                key = "-".join(model_name.split("/"))
+                path = build_tiny_model(model_name, train["text"], Path(tmp) / key)
+                Config.model2batchsize[str(path)] = args.batch_size
+
+                result: Dict[str, Any] = {
+                    "max_logit_difference": max_logit_difference(
+                        path, test["text"][:64], Config.max_length
+                    )
+                }
+                for packing in [False, True]:
+                    Config.packing = packing
+                    mode = "packed" if packing else "unpacked"
+                    collect()
+                    model_path = finetune(
+                        label2id, str(path), train, f"packing/{key}-{mode}"
+                    )
+                    (train_span,) = [
+                        x for x in collect() if x["name"] == "finetune/train"
+                    ]
+                    report = evaluate_finetuned(
+                        model_path, test, device=Config.device, name=f"{key}-{mode}"
+                    )
+                    result[mode] = {
+                        "train_seconds": train_span["wall_seconds"],
+                        "examples_per_second": len(train)
+                        * args.epochs
+                        / train_span["wall_seconds"],
+                        "tokens_per_second": train_span["tokens_per_second"],
+                        "accuracy": report["accuracy"],
+                        "macro avg-f1-score": report["macro avg"]["f1-score"],
+                    }
+
+                packed, unpacked = result["packed"], result["unpacked"]
+                result["speedup"] = unpacked["train_seconds"] / packed["train_seconds"]
+                result["accuracy_delta"] = packed["accuracy"] - unpacked["accuracy"]
+                result["within_tolerance"] = (
+                    abs(result["accuracy_delta"]) <= args.tolerance
+                )
+                results[model_name] = result
+                print(
+                    f"{model_name}: {result['speedup']:.2f}x, accuracy delta "
+                    f"{result['accuracy_delta']:+.4f}, max logit difference "
+                    f"{result['max_logit_difference']:.2e}"
+                )
+        finally:
+            os.chdir(cwd)
+            Config.training_args = training_args
+            Config.packing = False
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=[
+            "xlm-roberta-base",
+            "PlanTL-GOB-ES/roberta-base-bne",
+            "microsoft/deberta-v3-base",
+        ],
+    )
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--tolerance", type=float, default=0.02, help="Maximum accuracy difference."
+    )
+    main(parser.parse_args())
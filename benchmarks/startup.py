@@ -0,0 +1,106 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cold-start import time check for the lightweight commands of gvr.app.
+
+Each probe runs in a fresh interpreter under `-X importtime`. The check fails (exit code
+1) if a probe exceeds its budget or imports one of the heavy subsystems:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --scale 2.0  # e.g. on a slow machine
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List
+
+HEAVY_MODULES = ["torch", "transformers", "datasets", "sklearn", "pyarrow"]
+
+# Code run by each probe and its import time budget in milliseconds
+PROBES = {
+    # What `python -m gvr.app --help` (or any command) loads before dispatching
+    "cli": ("import gvr.app", 500),
+    # What `gather-results` additionally loads
+    "gather-results": ("import gvr.app, gvr.data", 1500),
+}
+
+
+def import_times(code: str) -> Dict[str, int]:
+    """Runs `code` in a fresh interpreter and returns the cumulative import time (us) of
+    each top-level module it imported.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header
+        # Nested imports are indented, top-level ones are not
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def imported_modules(code: str) -> List[str]:
+    process = subprocess.run(
+        [sys.executable, "-c", f"{code}; import sys; print(' '.join(sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return process.stdout.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", type=float, default=1.0, help="Budget multiplier.")
+    args = parser.parse_args()
+
+    report = []
+    failed = False
+    for name, (code, budget_ms) in PROBES.items():
+        times = import_times(code)
+        total_ms = sum(times.values()) / 1000
+        heavy = sorted(
+            {module.split(".")[0] for module in imported_modules(code)}
+            & set(HEAVY_MODULES)
+        )
+        ok = total_ms <= budget_ms * args.scale and not heavy
+        failed = failed or not ok
+        report.append(
+            {
+                "probe": name,
+                "import_ms": round(total_ms, 1),
+                "budget_ms": budget_ms * args.scale,
+                "heavy_modules": heavy,
+                "slowest": sorted(times.items(), key=lambda x: -x[1])[:5],
+                "ok": ok,
+            }
+        )
+
+    print(json.dumps(report, indent=4))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline benchmark of the pipeline stages on synthetic data and tiny local models.
+
+Writes AuTexTification-shaped TSVs (subtasks 1 and 2, train and test) to a temporary
+working directory, builds a tiny randomly initialized counterpart of each model in
+`Config.models` and times load_data, the experiments' data preparation, tokenization,
+one training epoch, evaluate_finetuned and gather_results. No data or hub downloads are
+needed:
+
+    python -m benchmarks.suite --output baseline.json
+    python -m benchmarks.suite --compare baseline.json --tolerance 0.2
+
+In compare mode, stages slower than the baseline by more than the tolerance are
+reported as regressions and the exit code is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import product
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+import torch
+from transformers import AutoTokenizer
+
+from gvr.configs import Config
+from gvr.data import gather_results, load_data
+from gvr.experiments import (
+    detection_transference_data,
+    model_family_data,
+    save_result,
+)
+from gvr.finetune import evaluate_finetuned, finetune
+from gvr.tokenization import TokenizationCache
+
+from .tiny_models import build_tiny_model
+
+DOMAINS = ["tweets", "reviews", "news", "legal", "wiki"]
+GENERATORS = ["A", "B", "C", "D", "E", "F"]
+WORDS = {
+    "en": "the of and to in a is that for it as was with be by on not he this".split(),
+    "es": "de la que el en y a los se del las un por con no una su para es".split(),
+}
+
+
+def synthetic_split(subtask: int, language: str, rows: int, seed: int) -> pd.DataFrame:
+    """Rows with the columns of the AuTexTification TSVs (id, text, label, domain).
+
+    Each label prefers a different part of the vocabulary, so detectors can learn.
+    """
+    rng = random.Random(seed)
+    labels = ["human", "generated"] if subtask == 1 else GENERATORS
+    words = WORDS[language]
+    records = []
+    for idx in range(rows):
+        label = labels[idx % len(labels)]
+        offset = labels.index(label)
+        length = rng.randint(10, 150)
+        text = " ".join(
+            words[(rng.randrange(len(words) // 2) + offset) % len(words)]
+            for _ in range(length)
+        )
+        records.append(
+            {"id": idx, "text": text, "label": label, "domain": rng.choice(DOMAINS)}
+        )
+    return pd.DataFrame(records).sample(frac=1, random_state=seed)
+
+
+def write_synthetic_data(root: Path, rows: int, languages: List[str]) -> None:
+    """Writes data/{split}/subtask_{n}/{language}/{split}.tsv under `root`.
+
+    Subtask 1 has more rows, as the human test subsets of the detection transference
+    experiment are sampled from it. Test splits have half the rows of train splits.
+    """
+    splits = product([1, 2], languages, ["train", "test"])
+    for seed, (subtask, language, split) in enumerate(splits):
+        n = rows * (3 if subtask == 1 else 1) // (1 if split == "train" else 2)
+        path = root / "data" / split / f"subtask_{subtask}" / language / f"{split}.tsv"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = synthetic_split(subtask, language, n, Config.SEED + seed)
+        # `load_data` expects a leading index column
+        data.reset_index(drop=True).to_csv(path, sep="\t")
+
+
+@contextmanager
+def timed(timings: Dict[str, float], name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    yield
+    timings[name] = round(time.perf_counter() - start, 4)
+    print(f"{name}: {timings[name]:.3f}s", file=sys.stderr)
+
+
+def run_suite(
+    rows: int, languages: List[str], models: Optional[List[str]] = None
+) -> Dict[str, float]:
+    """Runs every stage in a temporary working directory and returns their timings"""
+    timings: Dict[str, float] = {}
+    cwd = Path.cwd()
+    training_args = Config.training_args
+    model2batchsize = Config.model2batchsize
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            Config.training_args = {
+                **training_args,
+                "num_train_epochs": 1,
+                "report_to": [],
+                "disable_tqdm": True,
+            }
+            Config.model2batchsize = dict(model2batchsize)
+
+            write_synthetic_data(Path(tmp), rows, languages)
+
+            for language in languages:
+                for subtask, split in product([1, 2], ["train", "test"]):
+                    with timed(timings, f"load_data/cold/{subtask}/{language}/{split}"):
+                        load_data(subtask, language, split)
+                    with timed(timings, f"load_data/warm/{subtask}/{language}/{split}"):
+                        load_data(subtask, language, split)
+
+                with timed(timings, f"model_family_data/{language}"):
+                    train, test, label2id = model_family_data(language, "type")
+                with timed(timings, f"detection_transference_data/{language}"):
+                    detection_transference_data(language, "type")
+
+                for model_name in models or Config.models[language]:
+                    key = "-".join(model_name.split("/"))
+                    path = build_tiny_model(
+                        model_name, train["text"], Path(tmp) / "models" / key
+                    )
+                    Config.model2batchsize[str(path)] = 16
+
+                    tokenizer = AutoTokenizer.from_pretrained(str(path))
+                    with timed(timings, f"tokenization/{language}/{key}"):
+                        TokenizationCache(tokenizer).encode(train["text"])
+
+                    save_dirname = f"model_family/type/{language}/{key}"
+                    with timed(timings, f"train_epoch/{language}/{key}"):
+                        model_path = finetune(label2id, str(path), train, save_dirname)
+                    with timed(timings, f"evaluate_finetuned/{language}/{key}"):
+                        result = evaluate_finetuned(
+                            model_path, test, device=Config.device, name=save_dirname
+                        )
+                    results_path = Path(tmp) / "results" / Path(save_dirname).parent
+                    save_result(result, results_path, key)
+
+            with timed(timings, "gather_results"):
+                gather_results()
+        finally:
+            os.chdir(cwd)
+            Config.training_args = training_args
+            Config.model2batchsize = model2batchsize
+
+    return timings
+
+
+def compare(
+    current: Dict[str, float], baseline: Dict[str, float], tolerance: float
+) -> List[Dict[str, float]]:
+    """Stages slower than in `baseline` by more than `tolerance` (relative)"""
+    regressions = []
+    for stage, seconds in current.items():
+        if stage in baseline and seconds > baseline[stage] * (1 + tolerance):
+            regressions.append(
+                {
+                    "stage": stage,
+                    "baseline": baseline[stage],
+                    "current": seconds,
+                    "ratio": round(seconds / baseline[stage], 3),
+                }
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=600, help="Subtask 2 train rows.")
+    parser.add_argument("--languages", nargs="+", default=["en", "es"])
+    parser.add_argument(
+        "--models", nargs="+", default=None, help="Defaults to Config.models."
+    )
+    parser.add_argument("--output", type=Path, default=None, help="JSON report path.")
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="Baseline JSON report."
+    )
+    parser.add_argument(
+        "--current",
+        type=Path,
+        default=None,
+        help="Compare this report instead of running the suite.",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.current is not None:
+        with open(args.current, "r") as f:
+            report = json.load(f)
+    else:
+        torch.manual_seed(Config.SEED)
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "device": str(Config.device),
+                "threads": torch.get_num_threads(),
+                "rows": args.rows,
+            },
+            "timings": run_suite(args.rows, args.languages, args.models),
+        }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.compare is None:
+        print(json.dumps(report, indent=4))
+        return
+
+    with open(args.compare, "r") as f:
+        baseline = json.load(f)
+    regressions = compare(report["timings"], baseline["timings"], args.tolerance)
+    report = {"tolerance": args.tolerance, "regressions": regressions}
+    print(json.dumps(report, indent=4))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
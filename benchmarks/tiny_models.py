@@ -0,0 +1,125 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tiny, randomly initialized local models and tokenizers for offline benchmarks.
+
+Each architecture in `Config.models` has a tiny counterpart with the same model class,
+so benchmarks exercise the same code paths without hub downloads.
+"""
+
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from tokenizers import Tokenizer, models, pre_tokenizers, processors, trainers
+from transformers import (
+    AutoModelForSequenceClassification,
+    BloomConfig,
+    DebertaV2Config,
+    PretrainedConfig,
+    PreTrainedTokenizerFast,
+    RobertaConfig,
+    XLMRobertaConfig,
+)
+
+SPECIAL_TOKENS = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"]
+HIDDEN_SIZE = 64
+
+
+def _encoder_kwargs(vocab_size: int) -> Dict:
+    return dict(
+        vocab_size=vocab_size,
+        hidden_size=HIDDEN_SIZE,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=4 * HIDDEN_SIZE,
+        max_position_embeddings=514,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+    )
+
+
+ARCHITECTURES: Dict[str, Callable[[int], PretrainedConfig]] = {
+    "xlm-roberta-base": lambda v: XLMRobertaConfig(**_encoder_kwargs(v)),
+    "PlanTL-GOB-ES/roberta-base-bne": lambda v: RobertaConfig(**_encoder_kwargs(v)),
+    "microsoft/deberta-v3-base": lambda v: DebertaV2Config(
+        **{**_encoder_kwargs(v), "max_position_embeddings": 512},
+        relative_attention=True,
+        position_buckets=256,
+        pos_att_type=["p2c", "c2p"],
+        position_biased_input=False,
+        type_vocab_size=0,
+    ),
+    "bigscience/bloom-560m": lambda v: BloomConfig(
+        vocab_size=v,
+        hidden_size=HIDDEN_SIZE,
+        n_layer=2,
+        n_head=2,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+    ),
+}
+
+
+def build_tokenizer(texts: List[str], path: Path, vocab_size: int = 2000) -> int:
+    """Trains a word-level tokenizer on `texts`, saves it to `path` and returns its size"""
+    tokenizer = Tokenizer(models.WordLevel(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.train_from_iterator(
+        texts,
+        trainers.WordLevelTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS),
+    )
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A </s>",
+        special_tokens=[("<s>", 0), ("</s>", 2)],
+    )
+
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        cls_token="<s>",
+        sep_token="</s>",
+        unk_token="<unk>",
+        pad_token="<pad>",
+        mask_token="<mask>",
+        model_max_length=512,
+        model_input_names=["input_ids", "attention_mask"],
+    ).save_pretrained(str(path))
+
+    return tokenizer.get_vocab_size()
+
+
+def build_tiny_model(
+    model_name: str, texts: List[str], path: Path, num_labels: int = 2
+) -> Path:
+    """Saves a tiny, randomly initialized counterpart of `model_name` to `path`"""
+    path.mkdir(parents=True, exist_ok=True)
+    vocab_size = build_tokenizer(texts, path)
+    config = ARCHITECTURES[model_name](vocab_size)
+    config.num_labels = num_labels
+    AutoModelForSequenceClassification.from_config(config).save_pretrained(str(path))
+    return path
+
+
+def build_tiny_models(texts: List[str], root: Path) -> Dict[str, Path]:
+    """Builds the tiny counterpart of every architecture, by original model name"""
+    return {
+        model_name: build_tiny_model(
+            model_name, texts, root / "-".join(model_name.split("/"))
+        )
+        for model_name in ARCHITECTURES
+    }
@@ -0,0 +1,124 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Training throughput (samples/sec) of each training profile on a tiny local model.
+
+    python -m benchmarks.training_profiles --steps 50
+"""
+
+import argparse
+import json
+import random
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from datasets import Dataset
+from transformers import (
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    Trainer,
+    TrainingArguments,
+)
+
+from gvr.configs import Config
+from gvr.runtime import TrainingProfile, cpu_supports_bf16, training_profile
+
+from .tiny_models import build_tiny_model
+
+WORDS = "the of and to in a is that for it as was with be by on not he this are".split()
+
+
+def synthetic_texts(n: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120)))
+        for _ in range(n)
+    ]
+
+
+def profiles(device: torch.device) -> Dict[str, TrainingProfile]:
+    default = training_profile(device)
+    candidates = {"default": default, "fp32": default._replace(precision="fp32")}
+    if device.type == "cpu" and cpu_supports_bf16():
+        candidates["bf16"] = default._replace(precision="bf16")
+    if device.type == "cuda":
+        candidates["fp16"] = default._replace(precision="fp16")
+    candidates["single-thread"] = default._replace(intra_op_threads=1)
+    candidates["compile"] = default._replace(compile=True)
+    return candidates
+
+
+def run_profile(
+    profile: TrainingProfile, model_path: Path, data: Dataset, steps: int, output: Path
+) -> float:
+    torch.manual_seed(Config.SEED)
+    profile.apply()
+    tokenizer = AutoTokenizer.from_pretrained(str(model_path))
+    model = AutoModelForSequenceClassification.from_pretrained(str(model_path))
+    args = TrainingArguments(
+        output_dir=str(output),
+        per_device_train_batch_size=16,
+        max_steps=steps,
+        save_strategy="no",
+        report_to=[],
+        disable_tqdm=True,
+        **profile.training_arguments(Config.device),
+    )
+    trainer = Trainer(
+        model=model,
+        args=args,
+        train_dataset=data,
+        data_collator=DataCollatorWithPadding(tokenizer=tokenizer),
+    )
+    return trainer.train().metrics["train_samples_per_second"]
+
+
+def main(args: argparse.Namespace) -> None:
+    texts = synthetic_texts(args.samples)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = build_tiny_model(args.model, texts, Path(tmp) / "model")
+        tokenizer = AutoTokenizer.from_pretrained(str(model_path))
+        data = Dataset.from_dict(
+            {"text": texts, "label": [i % 2 for i in range(len(texts))]}
+        ).map(lambda x: tokenizer(x["text"], truncation=True), batched=True)
+        data = data.remove_columns("text")
+
+        for name, profile in profiles(Config.device).items():
+            try:
+                samples_per_second = run_profile(
+                    profile, model_path, data, args.steps, Path(tmp) / name
+                )
+            except Exception as e:
+                results[name] = {"profile": profile._asdict(), "error": repr(e)}
+                continue
+            results[name] = {
+                "profile": profile._asdict(),
+                "samples_per_second": samples_per_second,
+            }
+            print(f"{name}: {samples_per_second:.1f} samples/sec")
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="xlm-roberta-base")
+    parser.add_argument("--samples", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=30)
+    main(parser.parse_args())
@@ -12,23 +12,114 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 import typer
 
-from .data import gather_results as _gather_results
-from .experiments import (
-    detection_transference_experiment,
-    model_family_experiment,
-)
+from .configs import Config
+
+# Subsystems are imported by the commands that use them, so that lightweight commands
+# (e.g. gather-results or --help) don't pay for torch, transformers and datasets.
+# `python -m benchmarks.startup` checks the import time budget.
 
 app = typer.Typer()
 
+# Options shared by the commands that train detectors. They override `Config` attributes.
+MODE_OPTION = typer.Option(
+    "finetune", help="'finetune', or 'probe' for a linear head on frozen embeddings."
+)
+TRAIN_MAX_TOKENS_OPTION = typer.Option(
+    None,
+    help="Fill training batches up to this many padded tokens instead of a fixed "
+    "number of sequences.",
+)
+PACKING_OPTION = typer.Option(
+    False,
+    help="Pack several training examples per row with block-diagonal attention "
+    "(XLM-R, RoBERTa and DeBERTa models).",
+)
+
+
+# Config overrides set from the command line, forwarded to run-grid workers
+OVERRIDES: Dict[str, Any] = {}
+
+
+def configure(**overrides: Any) -> Dict[str, Any]:
+    """Sets `Config` attributes from command line options and returns all overrides"""
+    for key, value in overrides.items():
+        setattr(Config, key, value)
+    OVERRIDES.update(overrides)
+    return dict(OVERRIDES)
+
+
+@app.callback()
+def main(
+    precision: Optional[str] = typer.Option(
+        None, help="Training precision: fp32, fp16 or bf16. Defaults to the device's."
+    ),
+    intra_op_threads: Optional[int] = typer.Option(
+        None, help="Torch intra-op threads for training."
+    ),
+    inter_op_threads: Optional[int] = typer.Option(
+        None, help="Torch inter-op threads for training."
+    ),
+    dataloader_workers: Optional[int] = typer.Option(
+        None, help="Training dataloader worker processes."
+    ),
+    torch_compile: bool = typer.Option(False, help="Compile models with torch.compile."),
+    profiler: Optional[str] = typer.Option(
+        None,
+        help="Capture training and prediction with 'cprofile' or 'torch' (profiler) "
+        "into profiles/.",
+    ),
+    workers: int = typer.Option(
+        1, help="Run the command as this many data parallel (DDP) processes."
+    ),
+):
+    """Supervised machine-generated text detectors: family and scale experiments.
+
+    Options given before the command override the device-dependent training profile.
+    With --workers N, the command runs as N torch.distributed processes (gloo on CPU):
+    training batches are sharded, gradients all-reduced, evaluation is distributed and
+    only the first process writes checkpoints, outputs and results.
+    """
+    if workers > 1 and "LOCAL_RANK" not in os.environ:
+        argv = sys.argv[1:]
+        for idx, arg in enumerate(argv):
+            if arg == "--workers":
+                argv = argv[:idx] + argv[idx + 2 :]
+                break
+            if arg.startswith("--workers="):
+                argv = argv[:idx] + argv[idx + 1 :]
+                break
+        from .distributed import launch
+
+        raise typer.Exit(launch(workers, argv))
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        from .distributed import init_from_env
+
+        init_from_env()
+
+    configure(
+        precision=precision,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+        dataloader_workers=dataloader_workers,
+        torch_compile=torch_compile,
+        profiler=profiler,
+    )
+
 
 @app.command()
 def model_family_classification(
     language: str,
     family: str,
+    mode: str = MODE_OPTION,
+    train_max_tokens: Optional[int] = TRAIN_MAX_TOKENS_OPTION,
+    packing: bool = PACKING_OPTION,
 ) -> None:
     """Implements model family experiment for a given subtask and language.
 
@@ -37,11 +128,21 @@ def model_family_classification(
     if family not in ["params", "type"]:
         print("Family must be one of 'params', 'type'.")
 
+    configure(mode=mode, train_max_tokens=train_max_tokens, packing=packing)
+
+    from .experiments import model_family_experiment
+
     model_family_experiment(language, family)
 
 
 @app.command()
-def detection_transference(language: str, family: str):
+def detection_transference(
+    language: str,
+    family: str,
+    mode: str = MODE_OPTION,
+    train_max_tokens: Optional[int] = TRAIN_MAX_TOKENS_OPTION,
+    packing: bool = PACKING_OPTION,
+):
     """Implements detection capability transference experiment
 
     Combines Subtask 1 and Subtask 2 training data.
@@ -53,17 +154,322 @@ def detection_transference(language: str, family: str):
     if family not in ["params", "type"]:
         print("Family must be one of 'params', 'type'.")
 
+    configure(mode=mode, train_max_tokens=train_max_tokens, packing=packing)
+    from .experiments import detection_transference_experiment
+
     detection_transference_experiment(language, family)
 
 
 @app.command()
-def gather_results(filename: Optional[str] = "results", only_f1: bool = False):
+def gather_results(
+    filename: Optional[str] = "results",
+    only_f1: bool = False,
+    from_predictions: bool = typer.Option(
+        False, help="Recompute the metrics from the predictions in outputs/."
+    ),
+    bootstrap: int = typer.Option(
+        0,
+        help="Bootstrap resamples of the predictions in outputs/ for confidence "
+        "intervals and paired p-values. 0 disables them.",
+    ),
+    profile: bool = typer.Option(
+        False, help="Add tables with the stage timings of each result's profile."
+    ),
+    task: Optional[List[str]] = typer.Option(None, help="Only these tasks."),
+    family: Optional[List[str]] = typer.Option(None, help="Only these families."),
+    language: Optional[List[str]] = typer.Option(None, help="Only these languages."),
+    model: Optional[List[str]] = typer.Option(None, help="Only these models."),
+    pivot: Optional[str] = typer.Option(
+        None,
+        help="Write a model x test set table of this metric (e.g. 'macro avg-f1-score') "
+        "instead of all metrics.",
+    ),
+    all_runs: bool = typer.Option(
+        False, help="Show every indexed run (seeds, configs), not only the latest."
+    ),
+    reindex: bool = typer.Option(
+        False, help="Add result files missing from results/index.sqlite first."
+    ),
+):
     """Gathers the results of each experiment in tables in results/{filename}.md
 
-    The extension .md is automatically added to the filename.
+    The extension .md is automatically added to the filename. Results are read from the
+    results index, results/index.sqlite, which is built from the result files if needed.
+    """
+    from .data import gather_results as _gather_results
+
+    _gather_results(
+        filename,
+        only_f1,
+        from_predictions,
+        bootstrap,
+        profile,
+        tasks=task,
+        families=family,
+        languages=language,
+        models=model,
+        pivot=pivot,
+        all_runs=all_runs,
+        reindex=reindex,
+    )
+
+
+@app.command()
+def run_grid(
+    experiment: List[str] = typer.Option(
+        ["model_family", "detection_transfer"], help="Experiments to run."
+    ),
+    family: List[str] = typer.Option(["type", "params"], help="Families to run."),
+    language: List[str] = typer.Option(["en", "es"], help="Languages to run."),
+    model: Optional[List[str]] = typer.Option(
+        None, help="Restrict to these models from Config.models."
+    ),
+    workers: int = typer.Option(1, help="Number of worker processes."),
+    threads: Optional[int] = typer.Option(
+        None, help="CPU threads per worker. Defaults to cores / workers."
+    ),
+    ledger: Path = typer.Option(
+        Path("results/ledger.jsonl"), help="Ledger file with the state of each job."
+    ),
+    mode: str = MODE_OPTION,
+    train_max_tokens: Optional[int] = TRAIN_MAX_TOKENS_OPTION,
+    packing: bool = PACKING_OPTION,
+):
+    """Runs the experiment grid as (experiment, family, language, model, train_label)
+    jobs on a pool of worker processes.
+
+    Job states and wall times are recorded in the ledger. Rerunning the same command
+    skips jobs that are done with the same configuration.
+    """
+    from .scheduler import expand_jobs
+    from .scheduler import run_grid as _run_grid
+
+    overrides = configure(mode=mode, train_max_tokens=train_max_tokens, packing=packing)
+    jobs = expand_jobs(experiment, family, language, model)
+    _run_grid(jobs, ledger, workers=workers, threads=threads, overrides=overrides)
+
+
+@app.command()
+def predict(
+    model_path: Path,
+    input_path: Path,
+    output_path: Path,
+    chunk_size: int = typer.Option(10000, help="Rows read and scored at a time."),
+    max_tokens: Optional[int] = typer.Option(
+        None, help="Padded tokens per batch. Defaults to Config.inference_max_tokens."
+    ),
+    id_column: str = "id",
+    text_column: str = "text",
+):
+    """Scores a TSV/CSV/JSONL/Parquet file with a detector from checkpoints/.
+
+    Predictions are appended chunk by chunk as Parquet files in the output_path
+    directory. Rerunning an interrupted command resumes from the last complete chunk.
+    """
+    from .predict import predict as _predict
+
+    _predict(
+        model_path,
+        input_path,
+        output_path,
+        chunk_size=chunk_size,
+        max_tokens=max_tokens,
+        id_column=id_column,
+        text_column=text_column,
+    )
+
+
+@app.command()
+def serve(
+    model: List[str] = typer.Option(
+        ..., help="Detector to serve as name=checkpoint_path. Can be repeated."
+    ),
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = typer.Option(64, help="Maximum texts per micro-batch."),
+    max_wait_ms: float = typer.Option(
+        10.0, help="Maximum time a text waits for its micro-batch to fill."
+    ),
+    max_tokens: Optional[int] = typer.Option(
+        None, help="Padded tokens per batch. Defaults to Config.inference_max_tokens."
+    ),
+    threads: int = typer.Option(1, help="Inference worker threads."),
+):
+    """Serves finetuned detectors over HTTP on CPU, with dynamic micro-batching.
+
+    POST {"texts": [...]} to /predict/{name}. GET /metrics for queue depth, batch sizes
+    and latency percentiles.
+    """
+    models = {}
+    for spec in model:
+        name, _, path = spec.partition("=")
+        if not path:
+            raise typer.BadParameter(f"Expected name=checkpoint_path, got '{spec}'.")
+        models[name] = Path(path)
+
+    from .serve import serve as _serve
+
+    _serve(
+        models,
+        host=host,
+        port=port,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        max_tokens=max_tokens,
+        threads=threads,
+    )
+
+
+@app.command()
+def quantize(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = typer.Option(
+        None, help="Train label of the checkpoint, for the detection_transfer task."
+    ),
+):
+    """Quantizes a trained detector to int8 for CPU and compares it with the original.
+
+    The quantized checkpoint is saved next to the original as '{checkpoint}-int8'.
+    Accuracy delta, size and latency per batch are written to results/quantization/.
+    """
+    from .quantize import quantize_and_evaluate
+
+    quantize_and_evaluate(task, language, family, model, train_label)
+
+
+@app.command()
+def multitask(
+    language: str,
+    model: Optional[List[str]] = typer.Option(
+        None, help="Restrict to these models from Config.models."
+    ),
+):
+    """Trains one shared-encoder detector with heads for human vs generated, model
+    family (type) and model scale (params).
+
+    Each head's classification report is written to results/multitask/{language}/.
+    """
+    from .multitask import multitask_experiment
+
+    multitask_experiment(language, model)
+
+
+@app.command()
+def distill(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = typer.Option(
+        None, help="Train label of the teacher, for the detection_transfer task."
+    ),
+    layers: int = typer.Option(4, help="Transformer layers of the student."),
+    hidden_size: Optional[int] = typer.Option(
+        None,
+        help="Hidden size of the student. If not set, the student is a truncated copy "
+        "of the teacher, otherwise it is randomly initialized.",
+    ),
+    unlabeled: Optional[Path] = typer.Option(
+        None, help="Extra unlabeled texts (TSV/CSV/JSONL/Parquet with a 'text' column)."
+    ),
+    temperature: float = typer.Option(2.0, help="Softmax temperature of the KD loss."),
+    alpha: float = typer.Option(
+        0.5, help="Weight of the KD loss, the gold label loss gets 1 - alpha."
+    ),
+):
+    """Distills a trained detector into a smaller student model.
+
+    The student is saved as checkpoints/{checkpoint}-student-L{layers}[-H{hidden_size}].
+    Its test results, agreement with the teacher and latency/size ratios are written to
+    results/distillation/ under the same suffix.
+    """
+    from .distill import distill as _distill
+
+    _distill(
+        task,
+        language,
+        family,
+        model,
+        train_label,
+        layers=layers,
+        hidden_size=hidden_size,
+        unlabeled_path=unlabeled,
+        temperature=temperature,
+        alpha=alpha,
+    )
+
+
+@app.command()
+def cascade(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = typer.Option(
+        None, help="Train label of the checkpoint, for the detection_transfer task."
+    ),
+    target_accuracy: float = typer.Option(
+        0.98,
+        help="Accuracy stage 1 must reach on the documents it answers. Higher values "
+        "escalate more documents to the transformer.",
+    ),
+    holdout: float = typer.Option(
+        0.1, help="Fraction of the train set held out to calibrate the threshold."
+    ),
+):
+    """Puts a hashed n-gram linear classifier in front of a trained detector.
+
+    Only documents on which the n-gram classifier is not confident enough are escalated
+    to the transformer. Escalation rate, accuracy against the transformer alone and
+    throughput are written to results/cascade/.
+    """
+    from .cascade import cascade_experiment
+
+    cascade_experiment(
+        task,
+        language,
+        family,
+        model,
+        train_label,
+        target_accuracy=target_accuracy,
+        holdout=holdout,
+    )
+
+
+@app.command()
+def attribution(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = typer.Option(
+        None, help="Train label of the checkpoint, for the detection_transfer task."
+    ),
+    workers: Optional[int] = typer.Option(
+        None, help="Feature worker processes. Defaults to the number of cores."
+    ),
+    chunk_size: int = typer.Option(500, help="Texts per feature worker task."),
+):
+    """Readability statistics (textstat) of an evaluated detector's train and test sets,
+    grouped by label, prediction and label x prediction, in analysis/{checkpoint}.md.
+
+    Features are cached by text hash in cache/features/, so reruns only compute the
+    features of new texts.
     """
+    from .attribution import attribution as _attribution
 
-    _gather_results(filename, only_f1)
+    _attribution(
+        task,
+        language,
+        family,
+        model,
+        train_label,
+        workers=workers,
+        chunk_size=chunk_size,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import version
+from itertools import product
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import textstat
+
+from .configs import Config, fingerprint
+from .data import load_data, text_hash
+from .experiments import experiment_cell
+from .predictions import load_predictions
+
+# textstat metrics of the analysis tables, in order
+FEATURES = [
+    "flesch_reading_ease",
+    "flesch_kincaid_grade",
+    "gunning_fog",
+    "automated_readability_index",
+    "coleman_liau_index",
+    "linsear_write_formula",
+    "dale_chall_readability_score",
+    "text_standard",
+    "spache_readability",
+    "mcalpine_eflaw",
+    "reading_time",
+    "syllable_count",
+    "lexicon_count",
+    "sentence_count",
+    "char_count",
+    "letter_count",
+    "polysyllabcount",
+    "monosyllabcount",
+    "difficult_words",
+    "get_avg_syllables",
+]
+LANGUAGE_NAMES = {"en": "English", "es": "Spanish"}
+
+
+def _feature(name: str, text: str) -> float:
+    if name == "text_standard":
+        return textstat.text_standard(text, float_output=True)
+    if name == "get_avg_syllables":
+        return textstat.avg_syllables_per_word(text)
+    return getattr(textstat, name)(text)
+
+
+def _chunk_features(language: str, texts: List[str]) -> np.ndarray:
+    """Features of a chunk of texts, computed in a worker process"""
+    textstat.set_lang(language)
+    return np.array(
+        [[_feature(name, text) for name in FEATURES] for text in texts],
+        dtype=np.float64,
+    )
+
+
+class FeatureCache:
+    """Persistent cache of the textstat features of each text, by text hash.
+
+    Each language (and textstat version) owns a directory under cache/features/ with
+    one Parquet shard per batch of new texts. Only texts not in the cache are computed,
+    in chunks across a pool of processes.
+    """
+
+    def __init__(self, language: str, cache_dir: Optional[Path] = None):
+        self.language = language
+        meta = {
+            "language": language,
+            "features": FEATURES,
+            "textstat": version("textstat"),
+        }
+        if cache_dir is None:
+            cache_dir = Path.cwd() / Config.cache_dir / "features"
+        self.path = cache_dir / fingerprint(meta)[:16]
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        meta_path = self.path / "meta.json"
+        if not meta_path.exists():
+            with open(meta_path, "w") as f:
+                json.dump(meta, f, indent=4)
+
+        self._load()
+
+    def _load(self) -> None:
+        shards = [pd.read_parquet(path) for path in sorted(self.path.glob("shard-*"))]
+        self._data = (
+            pd.concat(shards).set_index("text_hash")
+            if shards
+            else pd.DataFrame(columns=FEATURES, index=pd.Index([], name="text_hash"))
+        )
+        # Concurrent runs may have written the same texts to different shards
+        self._data = self._data[~self._data.index.duplicated()]
+
+    def _write_shard(self, hashes: List[str], features: np.ndarray) -> None:
+        shard = pd.DataFrame(features, columns=FEATURES)
+        shard.insert(0, "text_hash", hashes)
+
+        # Write to a temporary file first so concurrent readers never see a partially
+        # written shard
+        name = f"shard-{uuid.uuid4().hex}.parquet"
+        tmp_path = self.path / f".tmp-{name}"
+        shard.to_parquet(tmp_path, index=False, compression="zstd")
+        tmp_path.rename(self.path / name)
+
+    def features(
+        self,
+        texts: Dict[str, str],
+        workers: Optional[int] = None,
+        chunk_size: int = 500,
+    ) -> pd.DataFrame:
+        """Returns the features of `texts` (by text hash), computing only unseen texts."""
+        missing = {h: t for h, t in texts.items() if h not in self._data.index}
+        if missing:
+            hashes = list(missing.keys())
+            chunks = [
+                [missing[h] for h in hashes[start : start + chunk_size]]
+                for start in range(0, len(hashes), chunk_size)
+            ]
+            print(f"Computing features of {len(hashes)} texts in {len(chunks)} chunks")
+            with ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                results = executor.map(
+                    _chunk_features, [self.language] * len(chunks), chunks
+                )
+                features = np.concatenate(list(results))
+            self._write_shard(hashes, features)
+            self._load()
+
+        return self._data.loc[list(texts.keys())]
+
+
+def store_texts(language: str) -> Dict[str, str]:
+    """Every text of the data store for `language`, by text hash"""
+    texts: Dict[str, str] = {}
+    for subtask, split in product([1, 2], ["train", "test"]):
+        data = load_data(subtask, language, split)
+        texts.update(zip(data["text_hash"], data["text"]))
+    return texts
+
+
+def grouped_means(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Mean features by label, by prediction and by label x prediction"""
+    correct = df["label"] == df["hyp_label"]
+    df = df.assign(
+        **{
+            "label X hyp_label": np.where(
+                correct,
+                df["label"] + "--CORRECT",
+                df["label"] + "-->" + df["hyp_label"] + "--INCORRECT",
+            )
+        }
+    )
+    return {
+        "label": df.groupby("label")[FEATURES].mean(),
+        "prediction": df.groupby("hyp_label")[FEATURES].mean(),
+        "label x prediction": df.groupby("label X hyp_label")[FEATURES].mean(),
+    }
+
+
+def attribution(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = None,
+    workers: Optional[int] = None,
+    chunk_size: int = 500,
+) -> Path:
+    """Writes the readability statistics of a grid cell to analysis/{checkpoint}.md.
+
+    Features are computed for the whole data store of `language` (only for texts not
+    cached yet) and joined by text hash with the stored predictions in outputs/, so the
+    cell must have been evaluated. Returns the path of the report.
+    """
+    name, train, test_sets = experiment_cell(task, language, family, model, train_label)
+
+    cache = FeatureCache(language)
+    features = cache.features(store_texts(language), workers, chunk_size)
+
+    train_df = pd.DataFrame(
+        {
+            "text_hash": [text_hash(text) for text in train["text"]],
+            "label": train["label"],
+        }
+    ).join(features, on="text_hash")
+
+    model_name = model.split("/")[-1]
+    output = [
+        f"# Data statistics with {model_name} in {LANGUAGE_NAMES[language]}",
+        "## Mean statistics of train set",
+        train_df.groupby("label")[FEATURES].mean().to_markdown(),
+    ]
+    for test_name, _ in test_sets.items():
+        path = Path.cwd() / "outputs" / f"{test_name}.parquet"
+        predictions, _ = load_predictions(path)
+        tables = grouped_means(predictions.join(features, on="text_hash"))
+        # Test sets are named after the checkpoint, and their test label if they differ
+        suffix = f" ({test_name.split('--')[-1]})" if len(test_sets) > 1 else ""
+        for on, table in tables.items():
+            output.append(f"## Mean statistics of test set on {on}{suffix}")
+            output.append(table.to_markdown())
+
+    path = Path.cwd() / "analysis" / f"{name}.md"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\n\n".join(output) + "\n")
+    print(f"Feature cache: {len(features)} texts, report written to {path}")
+    return path
@@ -0,0 +1,131 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def token_budget_batches(
+    lengths: Sequence[int], max_tokens: int, max_batch_size: Optional[int] = None
+) -> List[List[int]]:
+    """Groups example indices into length-sorted batches that fit a token budget.
+
+    Examples are sorted by decreasing length and added to the current batch while the
+    padded batch size (number of examples times the longest example) stays within
+    `max_tokens`. An example longer than the budget gets a batch of its own.
+    """
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind="stable")
+
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    batch_max_length = 0
+    for idx in order.tolist():
+        max_length = max(batch_max_length, lengths[idx])
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or max_length * (len(batch) + 1) > max_tokens):
+            batches.append(batch)
+            batch = []
+            max_length = lengths[idx]
+        batch.append(idx)
+        batch_max_length = max_length
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Training batch sampler that fills batches up to a padded-token budget.
+
+    Examples are split into buckets of similar length (sorted by length with random tie
+    breaks) and each bucket is cut into token-budget batches once, so the number of
+    batches per epoch is fixed. Every epoch shuffles the order of the buckets and of the
+    batches inside each bucket, which keeps training stochastic while batches stay
+    length-homogeneous.
+
+    With `num_replicas` > 1, each process gets a round-robin share of the shuffled
+    batches; every share has the same number of batches.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        seed: int,
+        bucket_size: int = 1024,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        self.lengths = list(lengths)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.epoch = 0
+
+        rng = np.random.default_rng(seed)
+        lengths_array = np.asarray(self.lengths)
+        tie_breaks = rng.random(len(lengths_array))
+        order = np.lexsort((tie_breaks, lengths_array))
+
+        self.buckets: List[List[List[int]]] = []
+        for start in range(0, len(order), bucket_size):
+            bucket = order[start : start + bucket_size].tolist()
+            bucket_lengths = [self.lengths[idx] for idx in bucket]
+            self.buckets.append(
+                [
+                    [bucket[i] for i in batch]
+                    for batch in token_budget_batches(bucket_lengths, max_tokens)
+                ]
+            )
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = [
+            self.buckets[bucket_idx][batch_idx]
+            for bucket_idx in rng.permutation(len(self.buckets)).tolist()
+            for batch_idx in rng.permutation(len(self.buckets[bucket_idx])).tolist()
+        ]
+        # Drop the last few batches so every process takes the same number of steps
+        batches = batches[: len(self) * self.num_replicas]
+        yield from batches[self.rank :: self.num_replicas]
+
+    @property
+    def num_batches(self) -> int:
+        """Number of batches of an epoch, over all processes"""
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def __len__(self) -> int:
+        return self.num_batches // self.num_replicas
+
+    @property
+    def mean_batch_size(self) -> float:
+        return len(self.lengths) / max(self.num_batches, 1)
+
+    def padding_stats(self) -> Tuple[int, int]:
+        """Returns the number of real and padded tokens of an epoch"""
+        real = sum(self.lengths)
+        padded = sum(
+            len(batch) * max(self.lengths[idx] for idx in batch)
+            for bucket in self.buckets
+            for batch in bucket
+        )
+        return real, padded
@@ -0,0 +1,217 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import classification_report
+from sklearn.pipeline import FeatureUnion
+
+from .configs import Config
+from .experiments import experiment_cell, save_result
+from .finetune import seed_all
+from .inference import Predictor
+from .predictions import save_predictions
+
+
+class NgramDetector:
+    """Linear classifier on hashed character and word n-grams (cascade stage 1).
+
+    Hashing keeps the vectorizer stateless, so only the linear model is fitted.
+    """
+
+    def __init__(self, n_features: int = 2**20):
+        self.vectorizer = FeatureUnion(
+            [
+                (
+                    "char",
+                    HashingVectorizer(
+                        analyzer="char_wb",
+                        ngram_range=(2, 5),
+                        n_features=n_features,
+                        alternate_sign=False,
+                    ),
+                ),
+                (
+                    "word",
+                    HashingVectorizer(
+                        ngram_range=(1, 2),
+                        n_features=n_features,
+                        alternate_sign=False,
+                    ),
+                ),
+            ]
+        )
+        self.classifier = SGDClassifier(
+            loss="log_loss", alpha=1e-6, max_iter=20, tol=None, random_state=Config.SEED
+        )
+
+    def fit(self, texts: List[str], labels: List[str]) -> "NgramDetector":
+        self.classifier.fit(self.vectorizer.transform(texts), labels)
+        return self
+
+    def predict_proba(self, texts: List[str]) -> np.ndarray:
+        return self.classifier.predict_proba(self.vectorizer.transform(texts))
+
+    @property
+    def labels(self) -> List[str]:
+        return self.classifier.classes_.tolist()
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path: Path) -> "NgramDetector":
+        return joblib.load(path)
+
+
+def calibrate_threshold(
+    confidence: np.ndarray, correct: np.ndarray, target_accuracy: float
+) -> float:
+    """Returns the lowest confidence at which stage 1 is still `target_accuracy` accurate.
+
+    Documents are sorted by decreasing confidence and the longest prefix whose accuracy
+    reaches the target is kept; the rest would be escalated. If no prefix does, every
+    document is escalated.
+    """
+    order = np.argsort(-confidence, kind="stable")
+    accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    (reached,) = np.nonzero(accuracy >= target_accuracy)
+    if len(reached) == 0:
+        return float("inf")
+    return float(confidence[order][reached[-1]])
+
+
+class CascadeDetector:
+    """Stage 1 answers the documents it is confident about, the rest are escalated to a
+    finetuned transformer.
+    """
+
+    def __init__(self, stage1: NgramDetector, predictor: Predictor, threshold: float):
+        self.stage1 = stage1
+        self.predictor = predictor
+        self.threshold = threshold
+
+    def predict(self, texts: List[str]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        probs = self.stage1.predict_proba(texts)
+        stage1_seconds = time.perf_counter() - start
+
+        labels = np.array(self.stage1.labels, dtype=object)[probs.argmax(axis=1)]
+        escalated = np.nonzero(probs.max(axis=1) < self.threshold)[0]
+
+        start = time.perf_counter()
+        if len(escalated):
+            escalated_labels, _ = self.predictor.predict([texts[i] for i in escalated])
+            labels[escalated] = escalated_labels
+        stage2_seconds = time.perf_counter() - start
+
+        return {
+            "labels": labels.tolist(),
+            "escalated": escalated,
+            "stage1_seconds": stage1_seconds,
+            "stage2_seconds": stage2_seconds,
+        }
+
+
+def cascade_experiment(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = None,
+    target_accuracy: float = 0.98,
+    holdout: float = 0.1,
+) -> None:
+    """Builds a cascade for a grid cell and compares it with its transformer alone.
+
+    Stage 1 is trained on the cell's train set minus a `holdout` fraction, on which the
+    escalation threshold is calibrated for `target_accuracy`. It is saved next to the
+    transformer checkpoint as {checkpoint}-ngram.joblib. Reports are written to
+    results/cascade/.
+    """
+    seed_all(Config.SEED)
+    name, train, test_sets = experiment_cell(task, language, family, model, train_label)
+    train = train.filter(lambda x: all([x["text"] != ""]))
+
+    rows = np.random.default_rng(Config.SEED).permutation(len(train))
+    n_holdout = max(1, int(holdout * len(train)))
+    calibration, fit = train.select(rows[:n_holdout]), train.select(rows[n_holdout:])
+
+    start = time.perf_counter()
+    stage1 = NgramDetector().fit(fit["text"], fit["label"])
+    fit_seconds = time.perf_counter() - start
+    stage1.save(Path.cwd() / "checkpoints" / f"{name}-ngram.joblib")
+
+    probs = stage1.predict_proba(calibration["text"])
+    correct = np.array(stage1.labels, dtype=object)[probs.argmax(axis=1)] == np.array(
+        calibration["label"], dtype=object
+    )
+    threshold = calibrate_threshold(probs.max(axis=1), correct, target_accuracy)
+
+    predictor = Predictor(Path.cwd() / "checkpoints" / name)
+    cascade = CascadeDetector(stage1, predictor, threshold)
+
+    for test_name, test in test_sets.items():
+        texts = test["text"]
+        # Fill the tokenization cache with the whole test set, so the transformer alone
+        # and the cascade both time cache hits instead of the first paying the misses
+        if predictor.cache is not None:
+            predictor.cache.encode(texts)
+        # Warm-up run so lazy initialization is not timed
+        predictor.predict(texts[: min(len(texts), 32)])
+
+        start = time.perf_counter()
+        baseline_labels, _ = predictor.predict(texts)
+        baseline_seconds = time.perf_counter() - start
+
+        output = cascade.predict(texts)
+        cascade_seconds = output["stage1_seconds"] + output["stage2_seconds"]
+        save_predictions(test, output["labels"], f"cascade/{test_name}")
+
+        cascade_report = classification_report(
+            y_true=test["label"], y_pred=output["labels"], output_dict=True
+        )
+        baseline_report = classification_report(
+            y_true=test["label"], y_pred=baseline_labels, output_dict=True
+        )
+        result = {
+            "cascade": cascade_report,
+            "transformer": baseline_report,
+            "threshold": threshold,
+            "target_accuracy": target_accuracy,
+            "escalation_rate": len(output["escalated"]) / len(texts),
+            "accuracy_delta": cascade_report["accuracy"] - baseline_report["accuracy"],
+            "throughput": {
+                "stage1_ms_per_text": 1000 * output["stage1_seconds"] / len(texts),
+                "cascade_texts_per_second": len(texts) / cascade_seconds,
+                "transformer_texts_per_second": len(texts) / baseline_seconds,
+                "speedup": baseline_seconds / cascade_seconds,
+            },
+            "stage1_fit_seconds": fit_seconds,
+        }
+
+        path = Path.cwd() / "results" / "cascade" / test_name
+        save_result(result, path.parent, path.name)
+        print(
+            f"{test_name}: escalation rate {result['escalation_rate']:.3f}, "
+            f"accuracy delta {result['accuracy_delta']:+.4f}, "
+            f"speedup {result['throughput']['speedup']:.2f}x"
+        )
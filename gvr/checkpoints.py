@@ -0,0 +1,186 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from transformers import TrainingArguments
+
+from .configs import Config, fingerprint
+
+# TrainingArguments that don't change the trained weights, including the per-machine
+# settings of the training profile (see gvr.runtime) and the per-process settings of
+# distributed launchers, which differ between the ranks of a run
+NON_TRAINING_ARGS = {
+    "output_dir",
+    "logging_dir",
+    "run_name",
+    "overwrite_output_dir",
+    "dataloader_num_workers",
+    "dataloader_pin_memory",
+    "no_cuda",
+    "xpu_backend",
+    "local_rank",
+    "ddp_backend",
+    "ddp_timeout",
+    "ddp_bucket_cap_mb",
+    "ddp_find_unused_parameters",
+    "tpu_num_cores",
+}
+
+
+def data_fingerprint(texts: List[str], labels: List[Any]) -> str:
+    """Hash of the training rows, in order"""
+    digest = hashlib.sha1()
+    for text, label in zip(texts, labels):
+        digest.update(f"{label}\t{text}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def training_fingerprint(
+    model_name: str,
+    texts: List[str],
+    labels: List[Any],
+    label2id: Dict[str, int],
+    training_args: TrainingArguments,
+    packing: bool = False,
+) -> str:
+    """Identifies a training run by its base model, data, arguments and seed.
+
+    `packing` is whether the run actually trains on packed rows (see `gvr.packing`).
+    """
+    args = {
+        k: v
+        for k, v in training_args.to_dict().items()
+        if k not in NON_TRAINING_ARGS and "hub" not in k
+    }
+    return fingerprint(
+        model_name,
+        data_fingerprint(texts, labels),
+        label2id,
+        args,
+        Config.max_length,
+        Config.train_max_tokens,
+        Config.SEED,
+        # Only part of the key when enabled, so earlier checkpoints keep their keys
+        *(["packing"] if packing else []),
+    )
+
+
+class CheckpointStore:
+    """Content-addressed store of finetuned checkpoints in checkpoints/.store/.
+
+    Checkpoints are stored by training fingerprint, and checkpoints/{save_dirname} is a
+    symlink to the stored checkpoint. A manifest keeps each entry's size, last use and
+    links. When the store grows over `Config.checkpoint_store_max_gb`, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, root: Optional[Path] = None):
+        self.root = Path.cwd() / "checkpoints" / ".store" if root is None else root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.root / "manifest.json"
+
+    @contextmanager
+    def _manifest(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """Locked read-modify-write access to the manifest, shared across processes"""
+        with open(self.root / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = {}
+            if self.manifest_path.exists():
+                with open(self.manifest_path, "r") as f:
+                    manifest = json.load(f)
+            yield manifest
+            tmp_path = self.manifest_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=4)
+            tmp_path.replace(self.manifest_path)
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def staging_path(self, key: str) -> Path:
+        """Where a checkpoint is trained before `commit` moves it into the store"""
+        return self.root / f".tmp-{key}-{os.getpid()}"
+
+    def get(self, key: str, link: Path) -> Optional[Path]:
+        """Links `link` to the checkpoint stored under `key`, if any"""
+        with self._manifest() as manifest:
+            if key not in manifest or not self.path(key).exists():
+                manifest.pop(key, None)
+                return None
+            manifest[key]["last_used"] = time.time()
+            self._link(key, link, manifest)
+        return link
+
+    def commit(self, key: str, link: Path, model_name: str) -> Path:
+        """Moves a trained checkpoint from its staging path into the store and links it"""
+        staging = self.staging_path(key)
+        with self._manifest() as manifest:
+            if self.path(key).exists():
+                # Trained concurrently by another process
+                shutil.rmtree(staging)
+            else:
+                staging.rename(self.path(key))
+            size = sum(
+                f.stat().st_size for f in self.path(key).rglob("*") if f.is_file()
+            )
+            now = time.time()
+            entry = manifest.setdefault(
+                key, {"model": model_name, "created": now, "links": []}
+            )
+            entry.update(size=size, last_used=now)
+            self._link(key, link, manifest)
+            self._evict(manifest, keep=key)
+        return link
+
+    def _link(self, key: str, link: Path, manifest: Dict[str, Dict[str, Any]]) -> None:
+        link.parent.mkdir(parents=True, exist_ok=True)
+        if link.is_symlink() or link.is_file():
+            link.unlink()
+        elif link.exists():
+            # Checkpoint trained before the store existed, it would be retrained anyway
+            shutil.rmtree(link)
+        link.symlink_to(os.path.relpath(self.path(key), link.parent))
+
+        relative_link = str(link.relative_to(self.root.parent))
+        for entry in manifest.values():
+            if relative_link in entry["links"]:
+                entry["links"].remove(relative_link)
+        manifest[key]["links"].append(relative_link)
+
+    def _evict(self, manifest: Dict[str, Dict[str, Any]], keep: str) -> None:
+        max_bytes = Config.checkpoint_store_max_gb * 2**30
+        total = sum(entry["size"] for entry in manifest.values())
+        for key in sorted(manifest, key=lambda k: manifest[k]["last_used"]):
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = manifest.pop(key)
+            total -= entry["size"]
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            for link in entry["links"]:
+                link_path = self.root.parent / link
+                if link_path.is_symlink():
+                    link_path.unlink()
+            print(f"Evicted checkpoint {key} ({entry['size'] / 2**30:.2f} GB)")
@@ -12,12 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import torch
+import hashlib
+import json
+from typing import Any, Dict
 
 
-class Config:
+class _LazyDevice(type):
+    """Resolves `Config.device` on first access, so importing the config (e.g. for
+    commands that only read results) doesn't import torch.
+    """
+
+    _device = None
+
+    @property
+    def device(cls):
+        if cls._device is None:
+            import torch
+
+            cls._device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        return cls._device
+
+    @device.setter
+    def device(cls, value):
+        cls._device = value
+
+
+class Config(metaclass=_LazyDevice):
     SEED = 42
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     models = {
         "en": [
             "xlm-roberta-base",
@@ -36,3 +57,61 @@ class Config:
         "microsoft/deberta-v3-base": 32,
         "bigscience/bloom-560m": 64,
     }
+    # "finetune" trains each detector end to end, "probe" trains a linear head on frozen
+    # embeddings of the backbone (fast mode for triage sweeps)
+    mode = "finetune"
+    # If set, training batches are filled up to this many padded tokens (grouping similar
+    # lengths) instead of using model2batchsize sequences per batch
+    train_max_tokens = None
+    # If set, training examples are packed into rows of max_length tokens with
+    # block-diagonal attention (encoders only, see gvr.packing)
+    packing = False
+    # Training profile overrides, None picks the setting from the device (see gvr.runtime)
+    precision = None  # "fp32", "fp16" or "bf16"
+    intra_op_threads = None
+    inter_op_threads = None
+    dataloader_workers = None
+    torch_compile = False
+    # Capture the training and prediction stages with "cprofile" or "torch" (profiler)
+    # into profiles/, see gvr.profiling
+    profiler = None
+    # Hyperparameters passed to `TrainingArguments` in `finetune`
+    training_args = {
+        "num_train_epochs": 5,
+        "weight_decay": 1e-3,
+        "learning_rate": 5e-5,
+        "logging_steps": 20,
+    }
+    # Directory (relative to the working directory) for persistent caches
+    cache_dir = "cache"
+    # Size of checkpoints/.store/ over which least recently used checkpoints are evicted
+    checkpoint_store_max_gb = 50
+    # Maximum number of tokens per example, longer texts are truncated
+    max_length = 512
+    # Maximum number of (padded) tokens per inference batch
+    inference_max_tokens = 16384
+
+
+# `Config` attributes that can change the result of a job. Per-machine settings
+# (threads, workers, compilation, cache locations and budgets) are left out so they
+# don't rerun finished jobs.
+RESULT_ATTRIBUTES = [
+    "SEED",
+    "mode",
+    "training_args",
+    "max_length",
+    "packing",
+    "train_max_tokens",
+    "precision",
+]
+
+
+def config_snapshot() -> Dict[str, Any]:
+    """`Config` attributes that can change the result of a job"""
+    return {k: getattr(Config, k) for k in RESULT_ATTRIBUTES}
+
+
+def fingerprint(*objects: Any) -> str:
+    """Stable hash of JSON-serializable objects, used to identify runs and cache entries"""
+    serialized = json.dumps(objects, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
@@ -12,106 +12,284 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fcntl
+import hashlib
 import json
+import os
+import shutil
+from collections import defaultdict
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
 import pandas as pd
-from datasets import Dataset
 
+from .configs import Config
+from .profiling import PROFILE_SUFFIX, profile_table
+from .results_index import backfill, backfilled, query_runs
 
-def load_data(subtask: int, language: str, split: str) -> Dataset:
+if TYPE_CHECKING:
+    from datasets import Dataset
+
+STORE_VERSION = 1
+STORE_META = "source.json"
+# Non-metric columns of the gathered tables
+LABEL_COLUMNS = ["model", "path", "train", "test", "seed", "config_hash", "p-value"]
+
+
+def text_hash(text: str) -> str:
+    """Content hash used to identify a text across datasets, caches and outputs"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _file_sha1(path: Path) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _build_store(source: Path, store: Path, split: str, meta: Dict[str, Any]) -> None:
+    """Converts a TSV split into an Arrow dataset with pre-computed columns"""
+    from datasets import Dataset
+
+    df = pd.read_csv(source, sep="\t", index_col=0).reset_index(drop=True)
+    df["text"] = df["text"].fillna("").astype(str)
+    df["text_length"] = df["text"].str.len()
+    df["text_hash"] = [text_hash(text) for text in df["text"]]
+
+    # Write to a temporary directory first so a crash never leaves a half-written store
+    tmp = store.with_name(f".tmp-{store.name}-{os.getpid()}")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    Dataset.from_pandas(df, split=split, preserve_index=False).save_to_disk(str(tmp))
+    with open(tmp / STORE_META, "w") as f:
+        json.dump(meta, f, indent=4)
+
+    if store.exists():
+        shutil.rmtree(store)
+    tmp.rename(store)
+
+
+def _source_meta(source: Path) -> Dict[str, Any]:
+    stat = source.stat()
+    return {
+        "version": STORE_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _stored_meta(store: Path) -> Optional[Dict[str, Any]]:
+    if not (store / STORE_META).exists():
+        return None
+    with open(store / STORE_META, "r") as f:
+        return json.load(f)
+
+
+def load_data(
+    subtask: int, language: str, split: str, refresh: bool = False
+) -> "Dataset":
+    """Loads a split from the Arrow data store, building it from the TSV if needed.
+
+    The store lives in {Config.cache_dir}/data/ and is memory-mapped on load. It is
+    rebuilt when the TSV changed (size or mtime differ and so does its content hash), or
+    when `refresh` is set. Besides the TSV columns, rows have `text_length` and `text_hash`.
+    """
     assert subtask in [1, 2]
     assert language in ["en", "es"]
     assert split in ["train", "test"]
 
-    path = (
-        Path.cwd()
-        / "data"
-        / split
-        / f"subtask_{subtask}"
-        / language
-        / f"{split}.tsv"
-    )
+    relative_path = Path(split) / f"subtask_{subtask}" / language
+    source = Path.cwd() / "data" / relative_path / f"{split}.tsv"
+    store = Path.cwd() / Config.cache_dir / "data" / relative_path
+
+    meta = _source_meta(source)
+    stored_meta = None if refresh else _stored_meta(store)
+    if stored_meta is None or any(stored_meta.get(k) != v for k, v in meta.items()):
+        # Concurrent workers (e.g. run-grid) check and build each store one at a time
+        store.parent.mkdir(parents=True, exist_ok=True)
+        with open(store.with_name(f".{store.name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stored_meta = None if refresh else _stored_meta(store)
+            fresh = stored_meta is not None and all(
+                stored_meta.get(k) == v for k, v in meta.items()
+            )
+            if stored_meta is not None and not fresh:
+                # Touched but not modified files (e.g. re-extracted archives) are still
+                # fresh
+                meta["sha1"] = _file_sha1(source)
+                fresh = (
+                    stored_meta.get("version") == STORE_VERSION
+                    and stored_meta.get("sha1") == meta["sha1"]
+                )
+                if fresh:
+                    # Replaced atomically, workers read it without the lock
+                    tmp_path = store / f".tmp-{STORE_META}-{os.getpid()}"
+                    with open(tmp_path, "w") as f:
+                        json.dump(meta, f, indent=4)
+                    tmp_path.replace(store / STORE_META)
+
+            if not fresh:
+                meta.setdefault("sha1", _file_sha1(source))
+                _build_store(source, store, split, meta)
+
+    # Imported here so that commands which only read results don't load datasets
+    from datasets import load_from_disk
 
-    df = pd.read_csv(path, sep="\t", index_col=0).reset_index(drop=True)
+    return load_from_disk(str(store))
 
-    return Dataset.from_pandas(df, split=split)
 
+def build_index(data: "Dataset", column: str) -> Dict[Any, List[int]]:
+    """Maps each value of `column` to the (ordered) indices of the rows that hold it"""
+    index: Dict[Any, List[int]] = defaultdict(list)
+    for idx, value in enumerate(data[column]):
+        index[value].append(idx)
+    return dict(index)
 
-def gather_results(filename: Optional[str] = "results", only_f1: bool = False) -> None:
-    """Gathers all results in results/ in a single big table (subj. to change)"""
 
-    results_all = {}
+def _result_frame(
+    runs: pd.DataFrame,
+    metrics: List[str],
+    from_predictions: bool,
+    all_runs: bool,
+) -> pd.DataFrame:
+    """Table of the runs of one (task, family, language): label columns, then metrics"""
+    if from_predictions:
+        # Imported here, gvr.predictions depends on this module
+        from .predictions import predictions_report
+        from .results_index import flatten_result
+
+        recomputed = pd.DataFrame(
+            [
+                dict(flatten_result(predictions_report(_prediction_path(path))))
+                for path in runs["path"]
+            ]
+        )
+        metrics = recomputed.columns.tolist()
+        runs = runs.drop(columns=metrics, errors="ignore").reset_index(drop=True)
+        runs = pd.concat([runs, recomputed], axis=1)
+
+    if runs["task"].iloc[0] == "detection_transfer":
+        df = runs[["model", "train_label", "test_label"]].rename(
+            columns={"train_label": "train", "test_label": "test"}
+        )
+    else:
+        df = pd.DataFrame({"path": runs["path"].str.rsplit("/", n=1).str[-1]})
+    if all_runs:
+        df = df.assign(seed=runs["seed"], config_hash=runs["config_hash"].str[:8])
+
+    # Reports may not share every label, missing metrics are left empty
+    columns = [
+        k
+        for k in metrics
+        if "support" not in k and "weighted" not in k and runs[k].notna().any()
+    ]
+    return pd.concat([df, runs[columns] * 100], axis=1).reset_index(drop=True)
+
+
+def _prediction_path(path: str) -> Path:
+    return Path.cwd() / "outputs" / f"{path}.parquet"
+
+
+def gather_results(
+    filename: Optional[str] = "results",
+    only_f1: bool = False,
+    from_predictions: bool = False,
+    bootstrap: int = 0,
+    profile: bool = False,
+    tasks: Optional[List[str]] = None,
+    families: Optional[List[str]] = None,
+    languages: Optional[List[str]] = None,
+    models: Optional[List[str]] = None,
+    pivot: Optional[str] = None,
+    all_runs: bool = False,
+    reindex: bool = False,
+) -> None:
+    """Gathers the results in the results index in tables, one per task, family and
+    language, written to results/{filename}.md.
+
+    The index is built from the files in results/ the first time, and with `reindex`
+    result files missing from it are added. Runs can be filtered by task, family,
+    language and model. By default only the latest run of each result is shown,
+    `all_runs` shows every seed and configuration. With `pivot` (a metric, e.g.
+    'macro avg-f1-score'), each table is a model x test set pivot of that metric,
+    averaged over runs.
+
+    With `from_predictions`, metrics are recomputed from the predictions in outputs/
+    instead of read from the index. With `bootstrap` resamples of the predictions,
+    95% confidence intervals and paired p-values against the best model of each test set
+    are added (see `gvr.stats`). With `profile`, each table is followed by the stage
+    timings of its {name}.profile.json files (see `gvr.profiling`).
+    """
     base_path = Path.cwd() / "results"
+    if reindex or not backfilled():
+        added = backfill(base_path)
+        print(f"Results index: {added} result files added")
+
+    runs, metrics = query_runs(tasks, families, languages, models, latest=not all_runs)
 
+    output = []
     for task in ["detection_transfer", "model_family"]:
         for family_type in ["type", "params"]:
             for language in ["en", "es"]:
-                results: Dict[str, List[Any]] = {}
-                path = base_path / task / family_type / language
-
-                for idx, result_path in enumerate(sorted(path.rglob("*.json"))):
-                    with open(result_path, "r") as f:
-                        current_result = json.load(f)
-
-                    unrolled_result = {}
-                    # Unindent dict
-                    for key in current_result.keys():
-                        if type(current_result[key]) == dict:
-                            for inner_key in current_result[key].keys():
-                                unrolled_result[
-                                    f"{key}-{inner_key}"
-                                ] = current_result[key][inner_key]
-                            del current_result[key][inner_key]
-                        else:
-                            unrolled_result[key] = current_result[key]
-
-                    if idx == 0:
-                        results["path"] = []
-                        for k in unrolled_result.keys():
-                            if "support" not in k and "weighted" not in k:
-                                results[k] = []
-
-                    results["path"].append(result_path.with_suffix("").name)
-                    for k in results.keys():
-                        if k != "path":
-                            if "support" not in k and "weighted" not in k:
-                                results[k].append(unrolled_result[k] * 100)
-
-                df = pd.DataFrame.from_dict(results)
-                results_all[task, family_type, language] = df
-
-    # Postprocess
-    for k in results_all.keys():  # type: ignore
-        if k[0] == "detection_transfer":
-            # get train and test from path
-            r = results_all[k]  # type: ignore
-            r.insert(0, "test", "")
-            r.insert(0, "train", "")
-            r.insert(0, "model", "")
-
-            r[["model", "train--test"]] = r["path"].str.split("_", expand=True)
-            r[["train", "test"]] = r["train--test"].str.split("--", expand=True)
-
-            r.drop(["path", "train--test"], axis=1, inplace=True)
-
-            results_all[k] = r  # type: ignore
+                cell = runs[
+                    (runs["task"] == task)
+                    & (runs["family"] == family_type)
+                    & (runs["language"] == language)
+                ]
+                if len(cell) == 0:
+                    continue
 
-    output = []
-    for k in results_all.keys():  # type: ignore
-        printable_k = f"**task: {k[0]}\tfamily: {k[1]}\tlanguage: {k[2]}**"
-        output.append(printable_k)
-        output.append("\n")
-        cols = results_all[k].columns
-        if only_f1:
-            cols = [x for x in results_all[k].columns if "f1" in x or x in ["model", "path", "train", "test"]]
-        output.append(
-            results_all[k][cols].to_markdown(  # type: ignore
-                index=False, tablefmt="github", floatfmt=".2f"
-            )
-        )
-        output.append("\n\n")
+                df = _result_frame(cell, metrics, from_predictions, all_runs)
+                if bootstrap:
+                    from .stats import bootstrap_table
+
+                    prediction_paths = [_prediction_path(x) for x in cell["path"]]
+                    df = pd.concat(
+                        [df, bootstrap_table(prediction_paths, bootstrap)], axis=1
+                    )
+
+                if pivot is not None:
+                    if task == "detection_transfer":
+                        df = df.assign(test=df["train"] + "--" + df["test"])
+                        df = df.pivot_table(
+                            index="model", columns="test", values=pivot, aggfunc="mean"
+                        )
+                    else:
+                        df = df.groupby("path")[[pivot]].mean()
+                    df = df.reset_index()
+
+                printable_k = (
+                    f"**task: {task}\tfamily: {family_type}\tlanguage: {language}**"
+                )
+                output.append(printable_k)
+                output.append("\n")
+                cols = df.columns
+                if only_f1 and pivot is None:
+                    cols = [x for x in df.columns if "f1" in x or x in LABEL_COLUMNS]
+                output.append(
+                    df[cols].to_markdown(  # type: ignore
+                        index=False,
+                        tablefmt="github",
+                        floatfmt=[".4f" if x == "p-value" else ".2f" for x in cols],
+                    )
+                )
+                output.append("\n\n")
+
+                profile_paths = [
+                    base_path / f"{x}{PROFILE_SUFFIX}" for x in cell["path"].unique()
+                ]
+                profile_paths = [x for x in profile_paths if x.exists()]
+                if profile and profile_paths:
+                    output.append(f"**profile of {printable_k[2:]}")
+                    output.append("\n")
+                    output.append(
+                        pd.DataFrame(profile_table(profile_paths)).to_markdown(
+                            index=False, tablefmt="github", floatfmt=".2f"
+                        )
+                    )
+                    output.append("\n\n")
 
     with open(base_path / f"{filename}.md", "w") as f:
         f.write("\n".join(output))
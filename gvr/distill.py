@@ -0,0 +1,237 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import (
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    PreTrainedModel,
+    Trainer,
+    TrainingArguments,
+)
+
+from .configs import Config
+from .distributed import barrier, is_main_process
+from .experiments import experiment_cell, save_result
+from .finetune import evaluate_finetuned, seed_all
+from .inference import Predictor
+from .predict import read_chunks
+from .quantize import directory_size_mb
+from .runtime import training_profile
+from .tokenization import TokenizationCache
+
+
+def build_student(
+    teacher: PreTrainedModel, layers: int, hidden_size: Optional[int] = None
+) -> PreTrainedModel:
+    """Builds a smaller copy of `teacher` with `layers` transformer layers.
+
+    Without `hidden_size`, the student keeps the teacher's width and is initialized with
+    its embeddings, first `layers` layers and classification head. A narrower student
+    is randomly initialized.
+    """
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = layers
+
+    if hidden_size is None:
+        student = AutoModelForSequenceClassification.from_config(config)
+        # Layers past `layers` are unexpected keys, everything else has the same shape
+        student.load_state_dict(teacher.state_dict(), strict=False)
+        return student
+
+    config.hidden_size = hidden_size
+    config.num_attention_heads = max(1, hidden_size // 64)
+    for attribute in ["intermediate_size", "pooler_hidden_size"]:
+        if hasattr(config, attribute):
+            setattr(
+                config,
+                attribute,
+                4 * hidden_size if attribute == "intermediate_size" else hidden_size,
+            )
+    return AutoModelForSequenceClassification.from_config(config)
+
+
+class DistillationTrainer(Trainer):
+    """Trains on the teacher's soft probabilities, plus the gold labels where known.
+
+    The loss is `alpha` * T^2 * KL(teacher_T || student_T) + (1 - alpha) * CE(gold), with
+    T the `temperature`. Rows without gold label (-100) only get the distillation loss.
+    """
+
+    def __init__(self, *args, temperature: float, alpha: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        teacher_probs = inputs.pop("teacher_probs")
+        labels = inputs.pop("labels")
+        outputs = model(**inputs)
+        logits = outputs.logits
+
+        T = self.temperature
+        teacher_log_probs = torch.log(teacher_probs.clamp(min=1e-12)) / T
+        loss = (
+            self.alpha
+            * T**2
+            * nn.functional.kl_div(
+                nn.functional.log_softmax(logits / T, dim=-1),
+                nn.functional.log_softmax(teacher_log_probs, dim=-1),
+                log_target=True,
+                reduction="batchmean",
+            )
+        )
+        if (labels != -100).any():
+            loss = loss + (1 - self.alpha) * nn.functional.cross_entropy(
+                logits, labels, ignore_index=-100
+            )
+
+        return (loss, outputs) if return_outputs else loss
+
+
+def _timed_predict(predictor: Predictor, texts: List[str]) -> Dict[str, Any]:
+    # Fill the tokenization cache with the whole test set, so tokenization is not timed
+    if predictor.cache is not None:
+        predictor.cache.encode(texts)
+    # Warm-up run so lazy initialization is not timed
+    predictor.predict(texts[: min(len(texts), 32)])
+    start = time.perf_counter()
+    labels, _ = predictor.predict(texts)
+    return {"labels": labels, "seconds": time.perf_counter() - start}
+
+
+def distill(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = None,
+    layers: int = 4,
+    hidden_size: Optional[int] = None,
+    unlabeled_path: Optional[Path] = None,
+    temperature: float = 2.0,
+    alpha: float = 0.5,
+) -> Path:
+    """Distills the checkpoint of a grid cell into a smaller student.
+
+    The student learns the teacher's probabilities on the cell's train texts and on the
+    texts of `unlabeled_path`. It is saved as a regular checkpoint next to the teacher
+    and evaluated with `evaluate_finetuned`. Reports with the student's test results,
+    its agreement with the teacher and the latency and size ratios are written to
+    results/distillation/.
+    """
+    seed_all(Config.SEED)
+    name, train, test_sets = experiment_cell(task, language, family, model, train_label)
+    teacher_path = Path.cwd() / "checkpoints" / name
+    suffix = f"-student-L{layers}" + (f"-H{hidden_size}" if hidden_size else "")
+    student_name = f"{name}{suffix}"
+    student_path = Path.cwd() / "checkpoints" / student_name
+
+    teacher = Predictor(teacher_path)
+    label2id = teacher.model.config.label2id
+
+    texts = [text for text in train["text"] if text != ""]
+    labels = [
+        label2id[label]
+        for text, label in zip(train["text"], train["label"])
+        if text != ""
+    ]
+    if unlabeled_path is not None:
+        for chunk in read_chunks(unlabeled_path, chunk_size=10000):
+            extra = [text for text in chunk["text"].tolist() if text != ""]
+            texts.extend(extra)
+            labels.extend([-100] * len(extra))
+
+    _, teacher_probs = teacher.predict(texts)
+
+    tokenizer = AutoTokenizer.from_pretrained(str(teacher_path))
+    data = TokenizationCache(tokenizer).encode(texts)
+    data = data.add_column("teacher_probs", teacher_probs.tolist())
+    data = data.add_column("labels", labels)
+    # The trainer keeps all columns so that the loss sees `teacher_probs`
+    data = data.select_columns(
+        ["input_ids", "attention_mask", "teacher_probs", "labels"]
+    )
+
+    student = build_student(teacher.model, layers, hidden_size)
+
+    profile = training_profile(Config.device)
+    profile.apply()
+    training_args = TrainingArguments(
+        output_dir=str(student_path),
+        per_device_train_batch_size=Config.model2batchsize.get(model, 32),
+        save_strategy="no",
+        remove_unused_columns=False,
+        **Config.training_args,
+        **profile.training_arguments(Config.device),
+    )
+    trainer = DistillationTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=data,
+        tokenizer=tokenizer,
+        data_collator=DataCollatorWithPadding(tokenizer=tokenizer),
+        temperature=temperature,
+        alpha=alpha,
+    )
+    trainer.train()
+    trainer.save_model()
+    barrier()
+
+    student_predictor = Predictor(student_path)
+    teacher_parameters = sum(p.numel() for p in teacher.model.parameters())
+    student_parameters = sum(p.numel() for p in student_predictor.model.parameters())
+
+    for test_name, test in test_sets.items():
+        result = evaluate_finetuned(
+            student_path,
+            test,
+            device=Config.device,
+            name=f"distillation/{test_name}{suffix}",
+        )
+        teacher_run = _timed_predict(teacher, test["text"])
+        student_run = _timed_predict(student_predictor, test["text"])
+        agreement = float(
+            np.mean(np.array(teacher_run["labels"]) == np.array(student_run["labels"]))
+        )
+        report = {
+            "student": result,
+            "teacher_accuracy": float(
+                np.mean(np.array(teacher_run["labels"]) == np.array(test["label"]))
+            ),
+            "agreement": agreement,
+            "latency_ratio": student_run["seconds"] / teacher_run["seconds"],
+            "size_ratio": directory_size_mb(student_path)
+            / directory_size_mb(teacher_path),
+            "parameters": {"teacher": teacher_parameters, "student": student_parameters},
+            "student_config": {"layers": layers, "hidden_size": hidden_size},
+        }
+        path = Path.cwd() / "results" / "distillation" / f"{test_name}{suffix}"
+        save_result(report, path.parent, path.name)
+        if is_main_process():
+            print(
+                f"{test_name}: agreement {agreement:.4f}, "
+                f"latency ratio {report['latency_ratio']:.2f}, "
+                f"size ratio {report['size_ratio']:.2f}"
+            )
+
+    return student_path
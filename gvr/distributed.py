@@ -0,0 +1,119 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Sequence, Tuple
+
+import numpy as np
+import torch.distributed as dist
+
+from .configs import Config
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return rank() == 0
+
+
+def barrier() -> None:
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj: Any) -> Any:
+    """Returns the main process's `obj` on every process"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def init_from_env() -> None:
+    """Joins the process group when launched by torch.distributed.run.
+
+    CPU workers communicate over gloo, GPU workers over nccl.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1 and not is_distributed():
+        backend = "nccl" if Config.device.type == "cuda" else "gloo"
+        dist.init_process_group(backend=backend)
+
+
+@contextmanager
+def main_process_first() -> Iterator[None]:
+    """Runs the block on the main process first, e.g. to build caches the other
+    processes then read instead of building them concurrently.
+    """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def shard(items: Sequence[Any]) -> List[Any]:
+    """Round-robin share of `items` for this process"""
+    return list(items[rank() :: world_size()])
+
+
+def gather_rows(indices: List[int], rows: np.ndarray, total: int) -> np.ndarray:
+    """Gathers the `rows` computed by each process for its `indices` into one array of
+    `total` rows, in the original order, on every process.
+    """
+    if not is_distributed():
+        output = np.zeros((total,) + rows.shape[1:], dtype=rows.dtype)
+        output[indices] = rows
+        return output
+
+    gathered: List[Tuple[List[int], np.ndarray]] = [None] * world_size()  # type: ignore
+    dist.all_gather_object(gathered, (indices, rows))
+    output = np.zeros((total,) + rows.shape[1:], dtype=rows.dtype)
+    for process_indices, process_rows in gathered:
+        output[process_indices] = process_rows
+    return output
+
+
+def launch(workers: int, argv: List[str]) -> int:
+    """Relaunches `python -m gvr.app {argv}` as `workers` local torch.distributed
+    processes, splitting the CPU cores between them.
+    """
+    env = os.environ.copy()
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else 1
+    env.setdefault("OMP_NUM_THREADS", str(max(1, cores // workers)))
+    command = [
+        sys.executable,
+        "-m",
+        "torch.distributed.run",
+        "--standalone",
+        f"--nproc_per_node={workers}",
+        "-m",
+        "gvr.app",
+        *argv,
+    ]
+    return subprocess.call(command, env=env)
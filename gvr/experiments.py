@@ -13,18 +13,115 @@
 # limitations under the License.
 
 import json
+from collections import Counter
+from contextlib import closing
 from functools import partial
-from itertools import product
 from pathlib import Path
-from typing import Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import pandas as pd
-from datasets import concatenate_datasets
+from datasets import Dataset, concatenate_datasets
 from datasets.formatting.formatting import LazyRow
 
 from .configs import Config
-from .data import load_data
-from .finetune import finetune_and_evaluate
+from .data import build_index, load_data
+from .distributed import is_main_process, main_process_first
+from .finetune import evaluate_finetuned, finetune
+from .probe import evaluate_probe, fit_probe
+from .profiling import PROFILE_SUFFIX, collect, span
+from .results_index import add_run, connect, run_config_hash
+
+
+# Subtask 2 labels (generator models) grouped by family for the model family experiment
+MODEL_FAMILY_MAPPINGS = {
+    "params": {
+        "A": "approx. 1b",
+        "B": "remove",
+        "C": "approx. 7b",
+        "D": "approx. 1b",
+        "E": "approx. 7b",
+        "F": "remove",
+    },
+    "type": {
+        "A": "bloom",
+        "B": "bloom",
+        "C": "bloom",
+        "D": "gpt",
+        "E": "gpt",
+        "F": "gpt",
+    },
+}
+MODEL_FAMILY_LABEL2ID = {
+    "params": {"approx. 1b": 0, "approx. 7b": 1},
+    "type": {"bloom": 0, "gpt": 1},
+}
+
+# Subtask 2 labels grouped by family for the detection transference experiment
+TRANSFERENCE_MAPPINGS = {
+    "params": {
+        "A": "1b",
+        "B": "remove",
+        "C": "7b",
+        "D": "1b",
+        "E": "7b",
+        "F": "175b",
+    },
+    "type": {
+        "A": "bloom",
+        "B": "bloom",
+        "C": "bloom",
+        "D": "gpt",
+        "E": "gpt",
+        "F": "gpt",
+    },
+}
+TRANSFERENCE_LABEL2LABEL = {
+    "params": {
+        "1b": "generated",
+        "7b": "generated",
+        "175b": "generated",
+        "human": "human",
+    },
+    "type": {
+        "bloom": "generated",
+        "gpt": "generated",
+        "human": "human",
+    },
+}
+TRANSFERENCE_LABEL2ID = {"generated": 0, "human": 1}
+
+
+def model_key(model: str) -> str:
+    """Name used for a model in checkpoints/, outputs/ and results/
+
+    Probe mode results get a '-probe' suffix so they sit next to the finetuned ones.
+    """
+    key = "-".join(model.split("/"))
+    if Config.mode == "probe":
+        key += "-probe"
+    return key
+
+
+def trainer_and_evaluator() -> Tuple[Callable, Callable]:
+    """Training and evaluation functions of the current `Config.mode`"""
+    if Config.mode == "probe":
+        return fit_probe, evaluate_probe
+    if Config.mode != "finetune":
+        raise RuntimeError("Mode must be one of 'finetune', 'probe'.")
+    return finetune, evaluate_finetuned
+
+
+def transference_labels(family: str) -> List[str]:
+    """Family labels detectors are trained and tested on in the transference experiment"""
+    return sorted(set(v for v in TRANSFERENCE_MAPPINGS[family].values() if v != "remove"))
+
+
+def check_arguments(language: str, family: str) -> None:
+    if family not in ["params", "type"]:
+        raise RuntimeError("Family must be one of 'params', 'type'.")
+    if language not in ["en", "es"]:
+        raise RuntimeError(
+            "The data is only available in English (en) or Spanish (es)."
+        )
 
 
 def map_label(example: LazyRow, mapping: Dict[str, str]) -> LazyRow:
@@ -41,24 +138,75 @@ def save_results(results: Dict[str, Dict], path: Path) -> None:
             json.dump(results[model], f, indent=4)
 
 
-def save_result(result: Dict, path: Path, name: str) -> None:
+def save_result(
+    result: Dict,
+    path: Path,
+    name: str,
+    profile: Optional[List[Dict]] = None,
+    entry: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Writes `result` to {path}/{name}.json, and the `profile` spans (see
+    `gvr.profiling`) that produced it to {path}/{name}.profile.json.
+
+    With an `entry` (task, family, language, model, mode, train and test label), the
+    result is also added to the results index (see `gvr.results_index`).
+    """
+    if not is_main_process():
+        return
     path.mkdir(parents=True, exist_ok=True)
     filename = f"{name}.json"
     with open(path / filename, "w") as f:
         json.dump(result, f, indent=4)
+    if profile is not None:
+        with open(path / f"{name}{PROFILE_SUFFIX}", "w") as f:
+            json.dump({"spans": profile}, f, indent=4)
+    if entry is not None:
+        relative_path = (path / name).relative_to(Path.cwd() / "results")
+        with closing(connect()) as conn:
+            add_run(conn, str(relative_path), entry, result, run_config_hash(entry))
+
+
+def _slice_index(
+    index: Dict[str, List[int]], key: str, start: int, stop: int
+) -> List[int]:
+    """Returns rows [start, stop) of `key` in `index`, failing like Dataset.select would"""
+    rows = index.get(key, [])
+    if stop > len(rows):
+        raise IndexError(
+            f"Requested rows up to {stop} of '{key}' but only {len(rows)} are available."
+        )
+    return rows[start:stop]
+
+
+def _merge_human_and_generated(
+    human: Dataset, generated: Dataset, label2label: Dict[str, str]
+) -> Dataset:
+    """Concatenates subtask 1 human text with subtask 2 generated text.
+
+    Only id, text and label columns are kept, and family labels are converted to
+    human vs generated so train and test share the same label space.
+    """
+    # only keep id text label columns
+    keep_columns = ["id", "text", "label"]
+    human = human.remove_columns([x for x in human.features if x not in keep_columns])
+    generated = generated.remove_columns(
+        [x for x in generated.features if x not in keep_columns]
+    )
 
+    assert human.features == generated.features
+
+    merged = concatenate_datasets([human, generated]).shuffle(Config.SEED)
+
+    # Convert family labels to human vs generated so we have same label in train and test
+    transform_labels = partial(map_label, mapping=label2label)
+    return merged.map(transform_labels)
 
-def model_family_experiment(
-    language: str,
-    family: str,
-) -> None:
-    """Implements the model family experiment."""
-    if family not in ["params", "type"]:
-        raise RuntimeError("Family must be one of 'params', 'type'.")
-    if language not in ["en", "es"]:
-        raise RuntimeError(
-            "The data is only available in English (en) or Spanish (es)."
-        )
+
+def model_family_data(
+    language: str, family: str
+) -> Tuple[Dataset, Dataset, Dict[str, int]]:
+    """Builds the train and test sets of the model family experiment."""
+    check_arguments(language, family)
 
     train = load_data(2, language, split="train")
     test = load_data(2, language, split="test")
@@ -70,26 +218,8 @@ def model_family_experiment(
         [x for x in test.features if x not in ["id", "text", "label"]]
     )
 
-    if family == "params":
-        mapping = {
-            "A": "approx. 1b",
-            "B": "remove",
-            "C": "approx. 7b",
-            "D": "approx. 1b",
-            "E": "approx. 7b",
-            "F": "remove",
-        }
-        label2id = {"approx. 1b": 0, "approx. 7b": 1}
-    else:
-        mapping = {
-            "A": "bloom",
-            "B": "bloom",
-            "C": "bloom",
-            "D": "gpt",
-            "E": "gpt",
-            "F": "gpt",
-        }
-        label2id = {"bloom": 0, "gpt": 1}
+    mapping = MODEL_FAMILY_MAPPINGS[family]
+    label2id = MODEL_FAMILY_LABEL2ID[family]
 
     if family == "params":
         not_remove = set([k for k, v in mapping.items() if v != "remove"])
@@ -100,59 +230,62 @@ def model_family_experiment(
     train = train.map(transform_labels)
     test = test.map(transform_labels)
 
+    return train, test, label2id
+
+
+def model_family_experiment(
+    language: str,
+    family: str,
+    models: Optional[List[str]] = None,
+) -> None:
+    """Implements the model family experiment.
+
+    `models` restricts the run to a subset of `Config.models[language]`.
+    """
+    with main_process_first(), span("data"):
+        train, test, label2id = model_family_data(language, family)
+    data_spans = collect()
+
     save_dirname = f"model_family/{family}/{language}/"
     save_dirpath = Path.cwd() / "results" / save_dirname
 
+    train_fn, evaluate_fn = trainer_and_evaluator()
+
     results = {}
-    for model in Config.models[language]:
-        key = "-".join(model.split("/"))
-        results[key] = finetune_and_evaluate(
-            model, label2id, train, test, save_dirname + key
-        )
+    for model in models or Config.models[language]:
+        key = model_key(model)
+        with span("train"):
+            detector = train_fn(label2id, model, train, save_dirname + key)
+        with span("evaluate"):
+            results[key] = evaluate_fn(
+                detector, test, device=Config.device, name=save_dirname + key
+            )
 
-        save_result(results[key], save_dirpath, key)
+        entry = {
+            "task": "model_family",
+            "family": family,
+            "language": language,
+            "model": key,
+            "mode": Config.mode,
+        }
+        save_result(results[key], save_dirpath, key, data_spans + collect(), entry)
 
 
-def detection_transference_experiment(language: str, family: str) -> None:
-    """Implements the detection transference experiment"""
-    if family not in ["params", "type"]:
-        raise RuntimeError("Family must be one of 'params', 'type'.")
-    if language not in ["en", "es"]:
-        raise RuntimeError(
-            "The data is only available in English (en) or Spanish (es)."
-        )
+def detection_transference_data(
+    language: str, family: str, train_labels: Optional[List[str]] = None
+) -> Tuple[
+    Dict[str, Dataset], Dict[Tuple[str, str], Dataset], Dict[str, int]
+]:
+    """Builds the train sets (by train label) and test sets (by train and test label)
+    of the detection transference experiment.
 
-    if family == "params":
-        mapping = {
-            "A": "1b",
-            "B": "remove",
-            "C": "7b",
-            "D": "1b",
-            "E": "7b",
-            "F": "175b",
-        }
-        label2label = {
-            "1b": "generated",
-            "7b": "generated",
-            "175b": "generated",
-            "human": "human",
-        }
-    else:
-        mapping = {
-            "A": "bloom",
-            "B": "bloom",
-            "C": "bloom",
-            "D": "gpt",
-            "E": "gpt",
-            "F": "gpt",
-        }
-        label2label = {
-            "bloom": "generated",
-            "gpt": "generated",
-            "human": "human",
-        }
+    The human test subset is sampled over the domains of the train split, so test sets
+    are indexed by both labels. `train_labels` restricts which train labels are built.
+    """
+    check_arguments(language, family)
 
-    label2id = {"generated": 0, "human": 1}
+    mapping = TRANSFERENCE_MAPPINGS[family]
+    label2label = TRANSFERENCE_LABEL2LABEL[family]
 
     # Load both subtasks' data
     train_1 = load_data(1, language, split="train")
@@ -182,104 +315,143 @@ def detection_transference_experiment(language: str, family: str) -> None:
     # assert train_1.features.type == train_2.features.type
     # assert test_1.features.type == test_2.features.type
 
-    save_dirname = f"detection_transfer/{family}/{language}/"
-    save_dirpath = Path.cwd() / "results" / save_dirname
+    labels = sorted(set(train_2["label"]))
+
+    # One-time indices so each grid cell is assembled with a single select()
+    domain_index = build_index(train_test_1, "domain")
+    train_2_label_index = build_index(train_2, "label")
+    test_2_label_index = build_index(test_2, "label")
+
+    def select_labels(data: Dataset, index: Dict[str, List[int]], label: str) -> Dataset:
+        # Same rows, in the same order, as filtering by (label, human_label)
+        return data.select(sorted(index.get(label, []) + index.get(human_label, [])))
+
+    train_sets = {}
+    test_sets = {}
+    for train_label in train_labels or labels:
+        current_train_2 = select_labels(train_2, train_2_label_index, train_label)
+        # There's more human text per domain in subtask 1 than generated text per domain in subtask 2
+        # We get same amount of human text per domain as train from top and test from bottom.
+        train_2_domain_counts = Counter(current_train_2["domain"])
+        domains = set(current_train_2["domain"])
+        train_1_indices: List[int] = []
+        for domain in domains:
+            train_1_indices.extend(
+                _slice_index(domain_index, domain, 0, train_2_domain_counts[domain])
+            )
 
-    results = {}
+        train_sets[train_label] = _merge_human_and_generated(
+            train_test_1.select(train_1_indices), current_train_2, label2label
+        )
 
-    labels = set(train_2["label"])
+        for test_label in labels:
+            current_test_2 = select_labels(test_2, test_2_label_index, test_label)
+            test_2_domain_counts = Counter(current_test_2["domain"])
+            test_1_indices: List[int] = []
+            for domain in domains:
+                test_1_indices.extend(
+                    _slice_index(
+                        domain_index,
+                        domain,
+                        len(current_test_2) - test_2_domain_counts[domain],
+                        len(current_test_2),
+                    )
+                )
 
-    for model in Config.models[language]:
-        for train_label, test_label in product(labels, labels):
-            current_train_2 = train_2.filter(
-                lambda x: x["label"] in (train_label, human_label)
-            )
-            current_test_2 = test_2.filter(
-                lambda x: x["label"] in (test_label, human_label)
+            test_sets[train_label, test_label] = _merge_human_and_generated(
+                train_test_1.select(test_1_indices), current_test_2, label2label
             )
 
-            # There's more human text per domain in subtask 1 than generated text per domain in subtask 2
-            # We get same amount of human text per domain as train from top and test from bottom.
-            train_2_domain_counts = pd.DataFrame(
-                current_train_2["domain"]
-            ).value_counts()
-            test_2_domain_counts = pd.DataFrame(
-                current_test_2["domain"]
-            ).value_counts()
-            current_train_1 = None
-            current_test_1 = None
-            for domain in set(current_train_2["domain"]):
-                current_domain = train_test_1.filter(
-                    lambda example: example["domain"] == domain
-                )
-                if current_train_1 == None:
-                    current_train_1 = current_domain.select(
-                        range(train_2_domain_counts[domain])
-                    )
-                else:
-                    current_train_1 = concatenate_datasets(
-                        [
-                            current_train_1,
-                            current_domain.select(
-                                range(train_2_domain_counts[domain])
-                            ),
-                        ]
-                    )
+    return train_sets, test_sets, TRANSFERENCE_LABEL2ID
 
-                if current_test_1 == None:
-                    current_test_1 = current_domain.select(
-                        range(
-                            len(current_test_2) - test_2_domain_counts[domain],
-                            len(current_test_2),
-                        )
-                    )
-                else:
-                    current_test_1 = concatenate_datasets(
-                        [
-                            current_test_1,
-                            current_domain.select(
-                                range(
-                                    len(current_test_2)
-                                    - test_2_domain_counts[domain],
-                                    len(current_test_2),
-                                )
-                            ),
-                        ]
-                    )
 
-            # only keep id text label columns
-            keep_columns = ["id", "text", "label"]
-            current_train_1 = current_train_1.remove_columns(
-                [x for x in current_train_1.features if x not in keep_columns]
-            )
-            current_train_2 = current_train_2.remove_columns(
-                [x for x in current_train_2.features if x not in keep_columns]
-            )
-            current_test_1 = current_test_1.remove_columns(
-                [x for x in current_test_1.features if x not in keep_columns]
-            )
-            current_test_2 = current_test_2.remove_columns(
-                [x for x in current_test_2.features if x not in keep_columns]
-            )
+def experiment_cell(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = None,
+) -> Tuple[str, Dataset, Dict[str, Dataset]]:
+    """Returns the checkpoint name, the train set and the test sets (by result name) of a
+    grid cell. Names are relative to checkpoints/, outputs/ and results/.
+    """
+    if task == "model_family":
+        train, test, _ = model_family_data(language, family)
+        name = f"model_family/{family}/{language}/{model_key(model)}"
+        return name, train, {name: test}
+
+    if task != "detection_transfer":
+        raise RuntimeError("Task must be one of 'model_family', 'detection_transfer'.")
+    if train_label is None:
+        raise RuntimeError("The detection transference experiment needs a train label.")
+
+    train_sets, test_sets, _ = detection_transference_data(
+        language, family, [train_label]
+    )
+    name = f"detection_transfer/{family}/{language}/{model_key(model)}_{train_label}"
+    return (
+        name,
+        train_sets[train_label],
+        {f"{name}--{test_label}": test for (_, test_label), test in test_sets.items()},
+    )
+
+
+def detection_transference_experiment(
+    language: str,
+    family: str,
+    models: Optional[List[str]] = None,
+    train_labels: Optional[List[str]] = None,
+) -> None:
+    """Implements the detection transference experiment
 
-            assert current_train_1.features == current_train_2.features
-            assert current_test_1.features == current_test_2.features
+    `models` and `train_labels` restrict the run to a subset of the grid.
+    """
+    with main_process_first(), span("data"):
+        train_sets, test_sets, label2id = detection_transference_data(
+            language, family, train_labels
+        )
+    data_spans = collect()
 
-            current_train = concatenate_datasets(
-                [current_train_1, current_train_2]
-            ).shuffle(Config.SEED)
-            current_test = concatenate_datasets(
-                [current_test_1, current_test_2]
-            ).shuffle(Config.SEED)
+    save_dirname = f"detection_transfer/{family}/{language}/"
+    save_dirpath = Path.cwd() / "results" / save_dirname
 
-            # Convert family labels to human vs generated so we have same label in train and test
-            transform_labels = partial(map_label, mapping=label2label)
-            current_train = current_train.map(transform_labels)
-            current_test = current_test.map(transform_labels)
+    train_fn, evaluate_fn = trainer_and_evaluator()
 
-            key = f"{'-'.join(model.split('/'))}_{train_label}--{test_label}"
-            results[key] = finetune_and_evaluate(
-                model, label2id, current_train, current_test, save_dirname + key
-            )
+    results = {}
+    for model in models or Config.models[language]:
+        # Training phase: one detector per train label
+        for train_label in train_sets.keys():
+            with span("train"):
+                detector = train_fn(
+                    label2id,
+                    model,
+                    train_sets[train_label],
+                    save_dirname + f"{model_key(model)}_{train_label}",
+                )
+            # Shared by the profiles of every test label
+            train_spans = collect()
+
+            # Evaluation phase: score the same detector on every test label
+            for (current_train_label, test_label), test in test_sets.items():
+                if current_train_label != train_label:
+                    continue
+                key = f"{model_key(model)}_{train_label}--{test_label}"
+                with span("evaluate"):
+                    results[key] = evaluate_fn(
+                        detector,
+                        test,
+                        device=Config.device,
+                        name=save_dirname + key,
+                    )
 
-            save_result(results[key], save_dirpath, key)
+                profile = data_spans + train_spans + collect()
+                entry = {
+                    "task": "detection_transfer",
+                    "family": family,
+                    "language": language,
+                    "model": model_key(model),
+                    "mode": Config.mode,
+                    "train_label": train_label,
+                    "test_label": test_label,
+                }
+                save_result(results[key], save_dirpath, key, profile, entry)
@@ -12,27 +12,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 import os
 import random
+import time
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, Optional, Union
 
 import numpy as np
-import pandas as pd
 import torch
 from datasets import Dataset
 from datasets.formatting.formatting import LazyRow
 from sklearn.metrics import classification_report
+from torch.utils.data import DataLoader
 from transformers import (
+    AutoConfig,
     AutoModelForSequenceClassification,
     AutoTokenizer,
     DataCollatorWithPadding,
     Trainer,
+    TrainerCallback,
     TrainingArguments,
-    pipeline,
 )
 
+from .batching import TokenBudgetBatchSampler
+from .checkpoints import CheckpointStore, training_fingerprint
 from .configs import Config
+from .distributed import (
+    barrier,
+    broadcast_object,
+    is_main_process,
+    rank,
+    world_size,
+)
+from .inference import Predictor
+from .packing import (
+    PackedClassifier,
+    PackedCollator,
+    PackingTrainer,
+    packed_dataset,
+    position_offset,
+    supports_packing,
+)
+from .predictions import save_predictions
+from .profiling import span
+from .runtime import training_profile
+from .tokenization import TokenizationCache
 
 
 def seed_all(seed: int):
@@ -45,9 +70,68 @@ def seed_all(seed: int):
     torch.backends.cudnn.benchmark = False
 
 
+class BatchStatsCallback(TrainerCallback):
+    """Logs the padding ratio and training throughput of each epoch"""
+
+    def __init__(self, batch_sampler: TokenBudgetBatchSampler):
+        self.batch_sampler = batch_sampler
+        self.epoch = 0
+        self.start = 0.0
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.batch_sampler.set_epoch(self.epoch)
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        elapsed = time.perf_counter() - self.start
+        real, padded = self.batch_sampler.padding_stats()
+        stats = {
+            "epoch": self.epoch,
+            "padding_ratio": 1 - real / padded,
+            "tokens_per_second": real / elapsed,
+            "padded_tokens_per_second": padded / elapsed,
+        }
+        state.log_history.append(stats)
+        print(stats)
+        self.epoch += 1
+
+
+class TokenBudgetTrainer(Trainer):
+    """Trainer whose training batches come from a `TokenBudgetBatchSampler`"""
+
+    def __init__(self, *args, batch_sampler: TokenBudgetBatchSampler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+        self.add_callback(BatchStatsCallback(batch_sampler))
+
+    def get_train_dataloader(self) -> DataLoader:
+        train_dataset = self._remove_unused_columns(
+            self.train_dataset, description="training"
+        )
+        return DataLoader(
+            train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+
 def finetune(
     label2id: Dict[str, int], model_name: str, data: Dataset, save_dirname: str
 ):
+    """Finetunes `model_name` on `data` and returns the checkpoint path.
+
+    Checkpoints are looked up in the `CheckpointStore` first: if the same base model was
+    already trained on the same rows with the same arguments and seed, training is
+    skipped and checkpoints/{save_dirname} links to the stored checkpoint.
+
+    With `Config.train_max_tokens`, batches are filled up to a token budget instead of
+    a fixed number of sequences, and gradient accumulation keeps the effective batch
+    close to `Config.model2batchsize`. With `Config.packing`, examples are packed into
+    rows of `Config.max_length` tokens instead (see `gvr.packing`), for the
+    architectures that support it.
+    """
     seed_all(Config.SEED)
 
     id2label = {v: k for k, v in label2id.items()}
@@ -56,7 +140,45 @@ def finetune(
         example["label"] = label2id[example["label"]]
         return example
 
-    data = data.map(preprocess_label)
+    with span("finetune/prepare"):
+        data = data.map(preprocess_label)
+        data = data.filter(lambda x: all([x["text"] != ""]))
+        texts = data["text"]
+        labels = data["label"]
+
+    output_dir = Path.cwd() / f"checkpoints/{save_dirname}"
+
+    profile = training_profile(Config.device)
+    profile.apply()
+    # Data parallel workers share the batch so the effective batch size is unchanged
+    training_args = TrainingArguments(
+        output_dir=output_dir,
+        per_device_train_batch_size=math.ceil(
+            Config.model2batchsize[model_name] / world_size()
+        ),
+        save_strategy="no",
+        **Config.training_args,
+        **profile.training_arguments(Config.device),
+    )
+
+    # Architectures without packing support train unpacked and share the unpacked key
+    model_config = AutoConfig.from_pretrained(model_name)
+    packing = Config.packing and supports_packing(model_config)
+    store = CheckpointStore()
+    # All processes must agree on the key, the cache hit and the staging path, or some
+    # would train while others skip to evaluation. The main process decides.
+    key = broadcast_object(
+        training_fingerprint(
+            model_name, texts, labels, label2id, training_args, packing
+        )
+    )
+    hit = is_main_process() and store.get(key, output_dir) is not None
+    if broadcast_object(hit):
+        print(f"Checkpoint cache hit for {save_dirname}: {key}")
+        return output_dir
+    staging_path = broadcast_object(store.staging_path(key))
+    training_args.output_dir = str(staging_path)
+    training_args.logging_dir = str(staging_path / "runs")
 
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = AutoModelForSequenceClassification.from_pretrained(
@@ -67,59 +189,110 @@ def finetune(
     )
     model = model.to(Config.device)
 
-    def tokenize(example: LazyRow) -> LazyRow:
-        return tokenizer(example["text"])
-
-    data = data.filter(lambda x: all([x["text"] != ""]))
-    data = data.map(tokenize, batched=True, remove_columns=["text"])
-
-    output_dir = Path.cwd() / f"checkpoints/{save_dirname}"
+    with span("finetune/tokenize") as record:
+        cache = TokenizationCache(tokenizer)
+        data = cache.encode(texts).add_column("label", labels)
+        record["tokens"] = sum(len(x) for x in data["input_ids"])
+    print(f"Tokenization cache: {cache.hits} hits, {cache.misses} misses")
 
     data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
-    training_args = TrainingArguments(
-        output_dir=output_dir,
-        per_device_train_batch_size=Config.model2batchsize[model_name],
-        num_train_epochs=5,
-        weight_decay=1e-3,
-        learning_rate=5e-5,
-        logging_steps=20,
-        save_strategy="no",
-        fp16=True,
-    )
 
-    trainer = Trainer(
+    trainer_kwargs = dict(
         model=model,
         args=training_args,
         train_dataset=data,
         tokenizer=tokenizer,
         data_collator=data_collator,
     )
+    if Config.packing and not packing:
+        print(f"Packing does not support {model.config.model_type}, training unpacked.")
 
-    trainer.train()
-    trainer.save_model()
+    if packing:
+        packed = packed_dataset(data, Config.max_length)
+        examples_per_row = len(data) / len(packed)
+        # Keep the number of examples per batch close to an unpacked run
+        training_args.per_device_train_batch_size = max(
+            1,
+            round(
+                Config.model2batchsize[model_name] / (examples_per_row * world_size())
+            ),
+        )
+        training_args.remove_unused_columns = False
+        print(
+            f"Packing: {len(data)} examples in {len(packed)} rows, "
+            f"{examples_per_row:.1f} examples and "
+            f"{record['tokens'] / len(packed):.0f} tokens per row on average"
+        )
+        trainer = PackingTrainer(
+            **{
+                **trainer_kwargs,
+                "model": PackedClassifier(model),
+                "train_dataset": packed,
+                "data_collator": PackedCollator(
+                    tokenizer.pad_token_id, position_offset(model.config)
+                ),
+            }
+        )
+    elif Config.train_max_tokens is None:
+        trainer = Trainer(**trainer_kwargs)
+    else:
+        batch_sampler = TokenBudgetBatchSampler(
+            [len(x) for x in data["input_ids"]],
+            Config.train_max_tokens,
+            Config.SEED,
+            num_replicas=world_size(),
+            rank=rank(),
+        )
+        training_args.gradient_accumulation_steps = max(
+            1,
+            round(
+                Config.model2batchsize[model_name]
+                / (batch_sampler.mean_batch_size * world_size())
+            ),
+        )
+        print(
+            f"Token budget batching: {len(batch_sampler)} batches of "
+            f"{batch_sampler.mean_batch_size:.1f} sequences on average, "
+            f"{training_args.gradient_accumulation_steps} accumulation steps"
+        )
+        trainer = TokenBudgetTrainer(**trainer_kwargs, batch_sampler=batch_sampler)
+
+    with span("finetune/train", capture=True) as train_record:
+        trainer.train()
+        train_record["tokens"] = record["tokens"] * training_args.num_train_epochs
+    # Only the main process writes the checkpoint
+    with span("finetune/save"):
+        trainer.save_model()
+        if is_main_process():
+            store.commit(key, output_dir, model_name)
+        barrier()
 
     return output_dir
 
 
 def evaluate_finetuned(
-    model_path: Union[str, Path], data: Dataset, device: torch.device
+    model_path: Union[str, Path],
+    data: Dataset,
+    device: torch.device,
+    name: Optional[str] = None,
 ):
-    pipe = pipeline("text-classification", model=str(model_path), device=device)
-    outputs = pipe(data["text"])
-    output_labels = [output["label"] for output in outputs]
-    true_labels = data["label"]
+    """Evaluates a finetuned checkpoint on `data`.
 
-    outputs_filename = f"{model_path.name}.tsv"
-    path_as_list = list(model_path.parent.parts)
-    path_as_list[path_as_list.index("checkpoints")] = "outputs"
-    output_dir = Path(*path_as_list)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_path = output_dir / outputs_filename
+    Predictions and class probabilities are written to outputs/{name}.parquet. If `name`
+    is not given, it is derived from the checkpoint path, which only works when each
+    checkpoint is evaluated once.
+    """
+    model_path = Path(model_path)
+    predictor = Predictor(model_path, device=device)
+    with span("predict", capture=True) as record:
+        output_labels, probs = predictor.predict(data["text"])
+        record["tokens"] = predictor.num_tokens
+    true_labels = data["label"]
 
-    df = pd.DataFrame(
-        {"id": data["id"], "text": data["text"], "hyp_label": output_labels}
-    )
-    df.to_csv(output_path, sep="\t", index=False)
+    if name is None:
+        parts = model_path.parts
+        name = "/".join(parts[parts.index("checkpoints") + 1 :])
+    save_predictions(data, output_labels, name, probs, predictor.id2label)
 
     results = classification_report(
         y_true=true_labels, y_pred=output_labels, output_dict=True
@@ -0,0 +1,119 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from transformers import (
+    AutoConfig,
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+)
+
+from .batching import token_budget_batches
+from .configs import Config
+from .distributed import gather_rows, shard, world_size
+from .tokenization import TokenizationCache
+
+# Weights of a dynamic int8 quantized checkpoint, saved by `gvr.quantize`
+QUANTIZED_WEIGHTS = "quantized_model.pt"
+
+
+def load_classifier(model_path: Union[str, Path]) -> torch.nn.Module:
+    """Loads a finetuned classifier, either a regular or an int8 quantized checkpoint."""
+    model_path = Path(model_path)
+    if not (model_path / QUANTIZED_WEIGHTS).exists():
+        return AutoModelForSequenceClassification.from_pretrained(str(model_path))
+
+    config = AutoConfig.from_pretrained(str(model_path))
+    model = AutoModelForSequenceClassification.from_config(config)
+    model = torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    model.load_state_dict(torch.load(model_path / QUANTIZED_WEIGHTS))
+    return model
+
+
+class Predictor:
+    """Batched inference engine for finetuned sequence classifiers.
+
+    Texts are tokenized once, sorted by length and grouped into batches that fit
+    `max_tokens` padded tokens. Each batch is padded only to its longest member and run
+    under `torch.inference_mode`. Outputs are scattered back into the input order.
+    With `cache`, tokenized texts are shared with training through `TokenizationCache`.
+    Quantized checkpoints always run on CPU.
+    """
+
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        device: Optional[torch.device] = None,
+        max_tokens: Optional[int] = None,
+        cache: bool = True,
+    ):
+        self.device = Config.device if device is None else device
+        if (Path(model_path) / QUANTIZED_WEIGHTS).exists():
+            self.device = torch.device("cpu")
+        self.max_tokens = Config.inference_max_tokens if max_tokens is None else max_tokens
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_path))
+        self.model = load_classifier(model_path).to(self.device).eval()
+        self.num_batches = 0
+        self.num_tokens = 0
+        self.id2label = {int(k): v for k, v in self.model.config.id2label.items()}
+        self.cache = TokenizationCache(self.tokenizer) if cache else None
+
+    @property
+    def labels(self) -> List[str]:
+        return [self.id2label[i] for i in range(len(self.id2label))]
+
+    def predict(self, texts: List[str]) -> Tuple[List[str], np.ndarray]:
+        """Returns the predicted label and the per-class probabilities of each text."""
+        if self.cache is not None:
+            encodings = self.cache.encode(texts).to_dict()
+        else:
+            encodings = self.tokenizer(
+                texts, truncation=True, max_length=Config.max_length
+            )
+        return self.predict_encoded(encodings)
+
+    def predict_encoded(self, encodings) -> Tuple[List[str], np.ndarray]:
+        """Same as `predict` for already tokenized (unpadded) inputs."""
+        input_ids = encodings["input_ids"]
+        lengths = [len(x) for x in input_ids]
+        probs = np.zeros((len(input_ids), len(self.id2label)), dtype=np.float32)
+
+        # Under torch.distributed, each process scores a share of the batches
+        batches = shard(token_budget_batches(lengths, self.max_tokens))
+        with torch.inference_mode():
+            for batch in batches:
+                features = [
+                    {key: encodings[key][idx] for key in encodings.keys()}
+                    for idx in batch
+                ]
+                inputs = self.tokenizer.pad(features, return_tensors="pt")
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                logits = self.model(**inputs).logits
+                probs[batch] = torch.softmax(logits.float(), dim=-1).cpu().numpy()
+                self.num_batches += 1
+                self.num_tokens += sum(lengths[idx] for idx in batch)
+
+        if world_size() > 1:
+            indices = [idx for batch in batches for idx in batch]
+            probs = gather_rows(indices, probs[indices], len(input_ids))
+
+        labels = [self.id2label[idx] for idx in probs.argmax(axis=-1).tolist()]
+        return labels, probs
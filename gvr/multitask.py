@@ -0,0 +1,256 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import math
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from datasets import Dataset, concatenate_datasets
+from sklearn.metrics import classification_report
+from torch import nn
+from transformers import (
+    AutoConfig,
+    AutoModel,
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    Trainer,
+    TrainingArguments,
+)
+
+from .batching import token_budget_batches
+from .configs import Config
+from .data import load_data
+from .distributed import is_main_process, main_process_first, world_size
+from .experiments import (
+    MODEL_FAMILY_LABEL2ID,
+    MODEL_FAMILY_MAPPINGS,
+    model_key,
+    save_result,
+)
+from .finetune import seed_all
+from .runtime import training_profile
+from .tokenization import TokenizationCache
+
+# Label space of each head
+TASKS = {
+    "detection": {"generated": 0, "human": 1},
+    "type": MODEL_FAMILY_LABEL2ID["type"],
+    "params": MODEL_FAMILY_LABEL2ID["params"],
+}
+MULTITASK_CONFIG = "multitask.json"
+IGNORE_INDEX = -100
+
+
+class MultiTaskDetector(nn.Module):
+    """Shared encoder with one classification head per task.
+
+    Heads read the masked mean of the last hidden states. Rows without a label for a
+    task (label IGNORE_INDEX) don't contribute to that task's loss.
+    """
+
+    def __init__(self, encoder: nn.Module, tasks: Dict[str, Dict[str, int]]):
+        super().__init__()
+        self.encoder = encoder
+        self.tasks = tasks
+        self.dropout = nn.Dropout(0.1)
+        self.heads = nn.ModuleDict(
+            {
+                task: nn.Linear(encoder.config.hidden_size, len(label2id))
+                for task, label2id in tasks.items()
+            }
+        )
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        detection_label: Optional[torch.Tensor] = None,
+        type_label: Optional[torch.Tensor] = None,
+        params_label: Optional[torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        hidden = self.encoder(
+            input_ids=input_ids, attention_mask=attention_mask
+        ).last_hidden_state
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = self.dropout((hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1))
+
+        outputs = {f"{task}_logits": head(pooled) for task, head in self.heads.items()}
+
+        labels = {
+            "detection": detection_label,
+            "type": type_label,
+            "params": params_label,
+        }
+        if any(label is not None for label in labels.values()):
+            loss = pooled.new_zeros(())
+            for task, label in labels.items():
+                if label is None:
+                    continue
+                known = label != IGNORE_INDEX
+                if known.any():
+                    loss = loss + nn.functional.cross_entropy(
+                        outputs[f"{task}_logits"][known], label[known]
+                    )
+            outputs["loss"] = loss
+
+        return outputs
+
+    def save(self, path: Path) -> None:
+        path.mkdir(parents=True, exist_ok=True)
+        torch.save(self.state_dict(), path / "pytorch_model.bin")
+        self.encoder.config.save_pretrained(str(path))
+        with open(path / MULTITASK_CONFIG, "w") as f:
+            json.dump({"tasks": self.tasks}, f, indent=4)
+
+    @classmethod
+    def load(cls, path: Path) -> "MultiTaskDetector":
+        with open(path / MULTITASK_CONFIG, "r") as f:
+            tasks = json.load(f)["tasks"]
+        encoder = AutoModel.from_config(AutoConfig.from_pretrained(str(path)))
+        model = cls(encoder, tasks)
+        model.load_state_dict(torch.load(path / "pytorch_model.bin", map_location="cpu"))
+        return model
+
+
+def _task_labels(example, subtask: int) -> Dict[str, int]:
+    """Labels of a row for every task, IGNORE_INDEX where the task doesn't apply"""
+    if subtask == 1:
+        return {
+            "detection_label": TASKS["detection"][example["label"]],
+            "type_label": IGNORE_INDEX,
+            "params_label": IGNORE_INDEX,
+        }
+
+    labels = {"detection_label": TASKS["detection"]["generated"]}
+    for task in ["type", "params"]:
+        family_label = MODEL_FAMILY_MAPPINGS[task][example["label"]]
+        labels[f"{task}_label"] = TASKS[task].get(family_label, IGNORE_INDEX)
+    return labels
+
+
+def multitask_data(language: str, split: str) -> Dataset:
+    """Subtask 1 (human vs generated) and subtask 2 (generator) rows with one label
+    column per task.
+    """
+    datasets = []
+    for subtask in [1, 2]:
+        data = load_data(subtask, language, split=split)
+        data = data.map(partial(_task_labels, subtask=subtask))
+        datasets.append(
+            data.remove_columns(
+                [x for x in data.features if x not in ["id", "text"] and "_label" not in x]
+            )
+        )
+    data = concatenate_datasets(datasets)
+    return data.filter(lambda x: x["text"] != "")
+
+
+def predict_multitask(
+    model: MultiTaskDetector, tokenizer, texts: List[str]
+) -> Dict[str, np.ndarray]:
+    """Per-task probabilities of each text, with a single encoder pass per text"""
+    encodings = TokenizationCache(tokenizer).encode(texts).to_dict()
+    lengths = [len(x) for x in encodings["input_ids"]]
+    probs = {
+        task: np.zeros((len(texts), len(label2id)), dtype=np.float32)
+        for task, label2id in model.tasks.items()
+    }
+
+    model = model.to(Config.device).eval()
+    with torch.inference_mode():
+        for batch in token_budget_batches(lengths, Config.inference_max_tokens):
+            features = [
+                {key: encodings[key][idx] for key in ["input_ids", "attention_mask"]}
+                for idx in batch
+            ]
+            inputs = tokenizer.pad(features, return_tensors="pt")
+            outputs = model(**{k: v.to(Config.device) for k, v in inputs.items()})
+            for task in model.tasks:
+                logits = outputs[f"{task}_logits"].float()
+                probs[task][batch] = torch.softmax(logits, dim=-1).cpu().numpy()
+
+    return probs
+
+
+def multitask_experiment(language: str, models: Optional[List[str]] = None) -> None:
+    """Trains one shared-encoder detector per model for human vs generated, model
+    family and model scale, and evaluates each head on its test rows.
+    """
+    if language not in ["en", "es"]:
+        raise RuntimeError(
+            "The data is only available in English (en) or Spanish (es)."
+        )
+
+    with main_process_first():
+        train = multitask_data(language, "train")
+        test = multitask_data(language, "test")
+
+    save_dirname = f"multitask/{language}/"
+    save_dirpath = Path.cwd() / "results" / save_dirname
+
+    for model_name in models or Config.models[language]:
+        seed_all(Config.SEED)
+        key = model_key(model_name)
+        output_dir = Path.cwd() / "checkpoints" / save_dirname / key
+
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = MultiTaskDetector(AutoModel.from_pretrained(model_name), TASKS)
+
+        label_columns = [f"{task}_label" for task in TASKS]
+        train_data = TokenizationCache(tokenizer).encode(train["text"])
+        for column in label_columns:
+            train_data = train_data.add_column(column, train[column])
+
+        profile = training_profile(Config.device)
+        profile.apply()
+        training_args = TrainingArguments(
+            output_dir=str(output_dir),
+            # Data parallel workers share the batch so the effective batch size is
+            # unchanged
+            per_device_train_batch_size=math.ceil(
+                Config.model2batchsize[model_name] / world_size()
+            ),
+            save_strategy="no",
+            label_names=label_columns,
+            **Config.training_args,
+            **profile.training_arguments(Config.device),
+        )
+        trainer = Trainer(
+            model=model,
+            args=training_args,
+            train_dataset=train_data,
+            data_collator=DataCollatorWithPadding(tokenizer=tokenizer),
+        )
+        trainer.train()
+
+        if is_main_process():
+            model.save(output_dir)
+            tokenizer.save_pretrained(str(output_dir))
+
+        probs = predict_multitask(model, tokenizer, test["text"])
+        for task, label2id in TASKS.items():
+            id2label = {v: k for k, v in label2id.items()}
+            labels = np.array(test[f"{task}_label"])
+            known = labels != IGNORE_INDEX
+            result = classification_report(
+                y_true=[id2label[i] for i in labels[known]],
+                y_pred=[id2label[i] for i in probs[task][known].argmax(axis=-1)],
+                output_dict=True,
+            )
+            save_result(result, save_dirpath, f"{key}_{task}")
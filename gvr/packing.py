@@ -0,0 +1,193 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import os
+from typing import Any, Dict, List, Optional
+
+import torch
+from datasets import Dataset
+from torch import nn
+from transformers import PretrainedConfig, PreTrainedModel, Trainer
+from transformers.trainer import TRAINING_ARGS_NAME
+
+# Architectures whose encoder takes 3D (block-diagonal) attention masks. BLOOM builds
+# its causal ALiBi mask from a 2D padding mask, so it trains unpacked.
+PACKABLE_MODEL_TYPES = ["xlm-roberta", "roberta", "deberta-v2"]
+
+
+def supports_packing(config: PretrainedConfig) -> bool:
+    return config.model_type in PACKABLE_MODEL_TYPES
+
+
+def pack_examples(lengths: List[int], max_length: int) -> List[List[int]]:
+    """Groups example indices into rows of at most `max_length` tokens.
+
+    Best-fit decreasing: longest examples first, each into the row with the least room
+    left that still fits it. Examples keep their original order within a row.
+    """
+    rows: List[List[int]] = []
+    # Sorted (room left, row) pairs of the rows that still have room
+    room: List[tuple] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: (-lengths[i], i)):
+        length = lengths[idx]
+        position = bisect.bisect_left(room, (length, -1))
+        if position < len(room):
+            left, row = room.pop(position)
+        else:
+            left, row = max_length, len(rows)
+            rows.append([])
+        rows[row].append(idx)
+        if left - length > 0:
+            bisect.insort(room, (left - length, row))
+    return [sorted(row) for row in rows]
+
+
+def packed_dataset(data: Dataset, max_length: int) -> Dataset:
+    """Concatenates the tokenized examples of `data` (input_ids, label) into rows.
+
+    Each row keeps the length and label of its examples so the collator can rebuild
+    their boundaries.
+    """
+    input_ids = data["input_ids"]
+    labels = data["label"]
+    rows = pack_examples([len(x) for x in input_ids], max_length)
+    return Dataset.from_dict(
+        {
+            "input_ids": [sum((input_ids[i] for i in row), []) for row in rows],
+            "lengths": [[len(input_ids[i]) for i in row] for row in rows],
+            "labels": [[labels[i] for i in row] for row in rows],
+        }
+    )
+
+
+class PackedCollator:
+    """Pads packed rows and builds, for each row, a block-diagonal attention mask and
+    position ids that restart at every example.
+
+    `position_offset` is the first position id (padding_idx + 1 for RoBERTa models).
+    `example_index` holds the (row, first token) of each example, for pooling.
+    """
+
+    def __init__(self, pad_token_id: int, position_offset: int = 0):
+        self.pad_token_id = pad_token_id
+        self.position_offset = position_offset
+
+    def __call__(self, rows: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        size = max(len(row["input_ids"]) for row in rows)
+        input_ids = torch.full((len(rows), size), self.pad_token_id, dtype=torch.long)
+        token_mask = torch.zeros((len(rows), size), dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), size, size), dtype=torch.uint8)
+        # Padding positions get padding_idx, as RoBERTa models would give them
+        position_ids = torch.full(
+            (len(rows), size), max(self.position_offset - 1, 0), dtype=torch.long
+        )
+        example_index = []
+        labels = []
+
+        for i, row in enumerate(rows):
+            input_ids[i, : len(row["input_ids"])] = torch.tensor(row["input_ids"])
+            start = 0
+            for length, label in zip(row["lengths"], row["labels"]):
+                end = start + length
+                token_mask[i, start:end] = 1
+                attention_mask[i, start:end, start:end] = 1
+                position_ids[i, start:end] = (
+                    torch.arange(length) + self.position_offset
+                )
+                example_index.append((i, start))
+                labels.append(label)
+                start = end
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_mask": token_mask,
+            "position_ids": position_ids,
+            "example_index": torch.tensor(example_index, dtype=torch.long),
+            "labels": torch.tensor(labels, dtype=torch.long),
+        }
+
+
+def position_offset(config: PretrainedConfig) -> int:
+    # RoBERTa models count positions from padding_idx + 1
+    if config.model_type in ["xlm-roberta", "roberta"]:
+        return config.pad_token_id + 1
+    return 0
+
+
+class PackedClassifier(nn.Module):
+    """Runs a sequence classifier on packed rows, pooling each example on its first
+    token with the model's own pooler and classification head.
+    """
+
+    def __init__(self, model: PreTrainedModel):
+        super().__init__()
+        if not supports_packing(model.config):
+            raise RuntimeError(f"Packing does not support {model.config.model_type}.")
+        self.model = model
+        self.config = model.config
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        token_mask: torch.Tensor,
+        position_ids: torch.Tensor,
+        example_index: torch.Tensor,
+        labels: Optional[torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        if self.config.model_type == "deberta-v2":
+            # The embeddings are masked per token, attention with the 3D mask
+            deberta = self.model.deberta
+            embeddings = deberta.embeddings(
+                input_ids=input_ids, position_ids=position_ids, mask=token_mask
+            )
+            hidden = deberta.encoder(
+                embeddings, attention_mask, output_hidden_states=True, return_dict=True
+            ).last_hidden_state
+        else:
+            hidden = self.model.base_model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                return_dict=True,
+            ).last_hidden_state
+
+        # (examples, 1, hidden): the heads pool the first token of their input
+        first_tokens = hidden[example_index[:, 0], example_index[:, 1]].unsqueeze(1)
+        if self.config.model_type == "deberta-v2":
+            pooled = self.model.dropout(self.model.pooler(first_tokens))
+            logits = self.model.classifier(pooled)
+        else:
+            logits = self.model.classifier(first_tokens)
+
+        outputs = {"logits": logits}
+        if labels is not None:
+            outputs["loss"] = nn.functional.cross_entropy(logits, labels)
+        return outputs
+
+
+class PackingTrainer(Trainer):
+    """Trainer for a `PackedClassifier` that saves the wrapped model as a regular
+    checkpoint, so it is evaluated like any other.
+    """
+
+    def _save(self, output_dir: Optional[str] = None, state_dict=None) -> None:
+        output_dir = output_dir if output_dir is not None else self.args.output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.model.model.save_pretrained(output_dir)
+        if self.tokenizer is not None:
+            self.tokenizer.save_pretrained(output_dir)
+        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
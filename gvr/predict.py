@@ -0,0 +1,127 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from .data import text_hash
+from .inference import Predictor
+from .predictions import predictions_table, write_table
+
+META_FILENAME = "_meta.json"
+
+
+def read_chunks(
+    path: Path, chunk_size: int, id_column: str = "id", text_column: str = "text"
+) -> Iterator[pd.DataFrame]:
+    """Streams `path` (TSV, CSV, JSONL or Parquet) in chunks of `chunk_size` rows.
+
+    Chunks have an `id` and a `text` column. If the input has no ids, row numbers are used.
+    """
+    suffix = path.suffix.lower()
+    if suffix in [".tsv", ".csv"]:
+        chunks = pd.read_csv(
+            path, sep="\t" if suffix == ".tsv" else ",", chunksize=chunk_size
+        )
+    elif suffix in [".jsonl", ".json"]:
+        chunks = pd.read_json(path, lines=True, chunksize=chunk_size)
+    elif suffix == ".parquet":
+        parquet = pq.ParquetFile(path)
+        columns = [c for c in [id_column, text_column] if c in parquet.schema.names]
+        chunks = (
+            batch.to_pandas()
+            for batch in parquet.iter_batches(batch_size=chunk_size, columns=columns)
+        )
+    else:
+        raise RuntimeError(f"Unsupported input format '{suffix}'.")
+
+    offset = 0
+    for chunk in chunks:
+        chunk = chunk.reset_index(drop=True)
+        ids = (
+            chunk[id_column]
+            if id_column in chunk.columns
+            else pd.Series(range(offset, offset + len(chunk)))
+        )
+        offset += len(chunk)
+        yield pd.DataFrame(
+            {"id": ids, "text": chunk[text_column].fillna("").astype(str)}
+        )
+
+
+def predict(
+    model_path: Path,
+    input_path: Path,
+    output_path: Path,
+    chunk_size: int = 10000,
+    max_tokens: Optional[int] = None,
+    id_column: str = "id",
+    text_column: str = "text",
+) -> None:
+    """Runs a finetuned detector over `input_path`, one chunk at a time.
+
+    Each chunk's predictions (id, text hash, label index and one float32 probability
+    column per class, see `gvr.predictions`) are written to their own Parquet file in
+    the `output_path` directory, so memory is bounded by the chunk size. Part files are
+    renamed into place once complete, and an interrupted run resumes after the last
+    complete part.
+    """
+    output_path.mkdir(parents=True, exist_ok=True)
+    meta = {
+        "model_path": str(model_path),
+        "input_path": str(input_path),
+        "chunk_size": chunk_size,
+    }
+    meta_path = output_path / META_FILENAME
+    if meta_path.exists():
+        with open(meta_path, "r") as f:
+            previous_meta = json.load(f)
+        if previous_meta != meta:
+            raise RuntimeError(
+                f"{output_path} holds predictions of a different run: {previous_meta}"
+            )
+    else:
+        with open(meta_path, "w") as f:
+            json.dump(meta, f, indent=4)
+
+    done = len(list(output_path.glob("part-*.parquet")))
+    if done:
+        print(f"Resuming after {done} completed chunks.")
+
+    # Tokenizations are not cached, the input may be arbitrarily large
+    predictor = Predictor(model_path, max_tokens=max_tokens, cache=False)
+
+    for idx, chunk in enumerate(
+        read_chunks(input_path, chunk_size, id_column, text_column)
+    ):
+        if idx < done:
+            continue
+
+        labels, probs = predictor.predict(chunk["text"].tolist())
+        table = predictions_table(
+            chunk["id"],
+            [text_hash(text) for text in chunk["text"]],
+            labels,
+            predictor.id2label,
+            probs=probs,
+        )
+
+        part = output_path / f"part-{idx:06d}.parquet"
+        write_table(table, part)
+        print(f"Chunk {idx}: {len(chunk)} rows written to {part.name}")
@@ -0,0 +1,143 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import Dataset
+from sklearn.metrics import classification_report
+
+from .data import text_hash
+from .distributed import is_main_process
+
+# Schema metadata key holding the label of each index of the label columns
+ID2LABEL_KEY = b"id2label"
+
+
+def predictions_table(
+    ids: Sequence,
+    hashes: Sequence[str],
+    output_labels: Sequence[str],
+    id2label: Dict[int, str],
+    probs: Optional[np.ndarray] = None,
+    true_labels: Optional[Sequence[str]] = None,
+) -> pa.Table:
+    """Builds the Parquet table of a set of predictions.
+
+    Labels are stored as int8 indices into `id2label` (kept in the schema metadata) and
+    probabilities as one float32 `prob_{label}` column per class of `id2label`. Texts are
+    not stored: `text_hash` joins the rows back to the data store.
+    """
+    id2label = dict(id2label)
+    label2id = {v: k for k, v in id2label.items()}
+    # Labels the detector doesn't know (e.g. in transference tests) still get an index
+    for label in [*output_labels, *(true_labels or [])]:
+        if label not in label2id:
+            label2id[label] = len(id2label)
+            id2label[label2id[label]] = label
+
+    columns = {
+        "id": list(ids),
+        "text_hash": list(hashes),
+    }
+    if true_labels is not None:
+        columns["label"] = np.array([label2id[x] for x in true_labels], dtype=np.int8)
+    columns["hyp_label"] = np.array([label2id[x] for x in output_labels], dtype=np.int8)
+    if probs is not None:
+        for idx in range(probs.shape[1]):
+            columns[f"prob_{id2label[idx]}"] = probs[:, idx].astype(np.float32)
+
+    table = pa.table(columns)
+    return table.replace_schema_metadata(
+        {ID2LABEL_KEY: json.dumps({str(k): v for k, v in id2label.items()})}
+    )
+
+
+def write_table(table: pa.Table, path: Path) -> None:
+    """Writes `table` to `path` as zstd Parquet, renaming it into place once complete"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".tmp-{path.name}")
+    pq.write_table(table, tmp_path, compression="zstd")
+    tmp_path.rename(path)
+
+
+def save_predictions(
+    data: Dataset,
+    output_labels: List[str],
+    name: str,
+    probs: Optional[np.ndarray] = None,
+    id2label: Optional[Dict[int, str]] = None,
+) -> None:
+    """Writes the predictions on `data` to outputs/{name}.parquet.
+
+    `probs` are the class probabilities, whose columns follow `id2label`. Without them,
+    only the predicted labels are stored.
+    """
+    if not is_main_process():
+        return
+
+    if "text_hash" in data.column_names:
+        hashes = data["text_hash"]
+    else:
+        hashes = [text_hash(text) for text in data["text"]]
+    if id2label is None:
+        id2label = dict(enumerate(sorted(set(output_labels))))
+
+    table = predictions_table(
+        data["id"],
+        hashes,
+        output_labels,
+        id2label,
+        probs=probs,
+        true_labels=data["label"] if "label" in data.column_names else None,
+    )
+    write_table(table, Path.cwd() / "outputs" / f"{name}.parquet")
+
+
+def load_predictions(path: Path) -> Tuple[pd.DataFrame, Dict[int, str]]:
+    """Reads predictions written by `save_predictions` or `gvr.predict`.
+
+    `path` is a Parquet file or a directory of Parquet parts. Label columns are decoded
+    back to label names. Returns the predictions and the `id2label` of the label indices.
+    """
+    table = pq.read_table(path)
+    metadata = table.schema.metadata or {}
+    id2label = {
+        int(k): v for k, v in json.loads(metadata.get(ID2LABEL_KEY, b"{}")).items()
+    }
+
+    df = table.to_pandas()
+    for column in ["label", "hyp_label"]:
+        if column in df.columns:
+            df[column] = df[column].map(id2label)
+    return df, id2label
+
+
+def prediction_probs(df: pd.DataFrame) -> Tuple[List[str], np.ndarray]:
+    """Returns the classes and the (n_rows, n_classes) probabilities of a predictions frame"""
+    columns = [x for x in df.columns if x.startswith("prob_")]
+    return [x[len("prob_") :] for x in columns], df[columns].to_numpy(np.float32)
+
+
+def predictions_report(path: Path) -> Dict:
+    """Recomputes the classification report of labeled predictions, without the model"""
+    df, _ = load_predictions(path)
+    return classification_report(
+        y_true=df["label"], y_pred=df["hyp_label"], output_dict=True
+    )
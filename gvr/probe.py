@@ -0,0 +1,174 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from datasets import Dataset
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import classification_report
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import StandardScaler
+from transformers import AutoModel, AutoTokenizer
+
+from .batching import token_budget_batches
+from .configs import Config, fingerprint
+from .data import text_hash
+from .finetune import seed_all
+from .predictions import save_predictions
+from .tokenization import TokenizationCache
+
+
+class EmbeddingCache:
+    """Pooled (masked mean) last-layer embeddings of a frozen backbone.
+
+    Embeddings are stored in cache/embeddings/ as memory-mapped NumPy shards, each with a
+    sibling array of text hashes. Every text is embedded once per backbone, whatever the
+    experiment or grid cell that needs it.
+    """
+
+    def __init__(self, model_name: str, cache_dir: Optional[Path] = None):
+        self.model_name = model_name
+        self._model = None
+        self._tokenizer = None
+
+        digest = fingerprint(model_name, Config.max_length, "mean")[:16]
+        if cache_dir is None:
+            cache_dir = Path.cwd() / Config.cache_dir / "embeddings"
+        self.path = cache_dir / f"{'-'.join(model_name.split('/'))}-{digest}"
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._load()
+
+    def _load(self) -> None:
+        self._shards = []
+        self._index: Dict[str, tuple] = {}
+        for path in sorted(self.path.glob("shard-*.npy")):
+            if path.name.endswith(".hashes.npy"):
+                continue
+            hashes = np.load(path.with_suffix(".hashes.npy"))
+            self._shards.append(np.load(path, mmap_mode="r"))
+            for row, h in enumerate(hashes.tolist()):
+                self._index[h] = (len(self._shards) - 1, row)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        if self._model is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self._model = AutoModel.from_pretrained(self.model_name)
+            self._model = self._model.to(Config.device).eval()
+
+        encodings = TokenizationCache(self._tokenizer).encode(texts).to_dict()
+        lengths = [len(x) for x in encodings["input_ids"]]
+        embeddings = np.zeros(
+            (len(texts), self._model.config.hidden_size), dtype=np.float32
+        )
+
+        with torch.inference_mode():
+            for batch in token_budget_batches(lengths, Config.inference_max_tokens):
+                features = [
+                    {key: encodings[key][idx] for key in encodings.keys()}
+                    for idx in batch
+                ]
+                inputs = self._tokenizer.pad(features, return_tensors="pt")
+                inputs = {k: v.to(Config.device) for k, v in inputs.items()}
+                hidden = self._model(**inputs).last_hidden_state.float()
+                mask = inputs["attention_mask"].unsqueeze(-1).float()
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1.0)
+                embeddings[batch] = pooled.cpu().numpy()
+
+        return embeddings
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Returns the embeddings of `texts`, in order, computing only unseen texts"""
+        hashes = [text_hash(text) for text in texts]
+
+        missing: Dict[str, str] = {}
+        for h, text in zip(hashes, texts):
+            if h not in self._index and h not in missing:
+                missing[h] = text
+
+        if missing:
+            embeddings = self._embed(list(missing.values()))
+            name = f"shard-{uuid.uuid4().hex}"
+            np.save(self.path / f"{name}.hashes.npy", np.array(list(missing.keys())))
+            # The embeddings file is written last: a shard only exists once it's complete
+            tmp_path = self.path / f".tmp-{name}.npy"
+            np.save(tmp_path, embeddings)
+            tmp_path.rename(self.path / f"{name}.npy")
+            self._load()
+
+        return np.stack(
+            [self._shards[shard][row] for shard, row in map(self._index.get, hashes)]
+        )
+
+
+class ProbeDetector:
+    """Logistic regression head on top of the frozen embeddings of a backbone"""
+
+    def __init__(self, model_name: str, classifier: Pipeline):
+        self.model_name = model_name
+        self.classifier = classifier
+        self.embeddings = EmbeddingCache(model_name)
+
+    @property
+    def labels(self) -> List[str]:
+        return self.classifier.classes_.tolist()
+
+    def predict(self, texts: List[str]) -> Tuple[List[str], np.ndarray]:
+        """Returns the predicted label and the per-class probabilities of each text."""
+        probs = self.classifier.predict_proba(self.embeddings.encode(texts))
+        return np.array(self.labels)[probs.argmax(axis=1)].tolist(), probs
+
+
+def fit_probe(
+    label2id: Dict[str, int], model_name: str, data: Dataset, save_dirname: str
+) -> ProbeDetector:
+    """Counterpart of `finetune` for the probe mode: trains a linear head on frozen
+    embeddings. Nothing is saved to checkpoints/, the embeddings are cached instead.
+    """
+    seed_all(Config.SEED)
+
+    data = data.filter(lambda x: all([x["text"] != ""]))
+    embeddings = EmbeddingCache(model_name).encode(data["text"])
+
+    classifier = make_pipeline(
+        StandardScaler(),
+        LogisticRegression(max_iter=1000, random_state=Config.SEED),
+    )
+    classifier.fit(embeddings, data["label"])
+
+    return ProbeDetector(model_name, classifier)
+
+
+def evaluate_probe(
+    detector: ProbeDetector,
+    data: Dataset,
+    device: torch.device,
+    name: Optional[str] = None,
+):
+    """Counterpart of `evaluate_finetuned` for the probe mode"""
+    output_labels, probs = detector.predict(data["text"])
+    if name is not None:
+        id2label = dict(enumerate(detector.labels))
+        save_predictions(data, output_labels, name, probs, id2label)
+
+    results = classification_report(
+        y_true=data["label"], y_pred=output_labels, output_dict=True
+    )
+
+    return results
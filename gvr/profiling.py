@@ -0,0 +1,157 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from .configs import Config
+
+PROFILE_SUFFIX = ".profile.json"
+
+# Finished spans since the last `collect()`, and the spans currently open
+_SPANS: List[Dict[str, Any]] = []
+_OPEN: List[Dict[str, Any]] = []
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _cuda():
+    # Without torch loaded (e.g. light commands) there is no CUDA memory to report
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda
+
+
+def _update_cuda_peak(record: Dict[str, Any]) -> None:
+    cuda = _cuda()
+    if cuda is not None:
+        peak = cuda.max_memory_allocated() / 2**20
+        record["cuda_peak_mb"] = max(record.get("cuda_peak_mb", 0.0), peak)
+
+
+@contextmanager
+def _capture(name: str) -> Iterator[Optional[Path]]:
+    """Runs the block under cProfile or torch.profiler, depending on `Config.profiler`"""
+    if Config.profiler is None:
+        yield None
+        return
+
+    directory = Path.cwd() / "profiles"
+    directory.mkdir(parents=True, exist_ok=True)
+    stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{name.replace('/', '-')}"
+    if Config.profiler == "cprofile":
+        path = directory / f"{stem}.prof"
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            profiler.dump_stats(str(path))
+    elif Config.profiler == "torch":
+        import torch
+
+        path = directory / f"{stem}.trace.json"
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities) as profiler:
+            yield path
+        profiler.export_chrome_trace(str(path))
+    else:
+        raise RuntimeError("Config.profiler must be one of None, 'cprofile', 'torch'.")
+
+
+@contextmanager
+def span(name: str, capture: bool = False) -> Iterator[Dict[str, Any]]:
+    """Times a stage: wall and CPU seconds, peak RSS and peak CUDA memory.
+
+    The yielded record can be given a `tokens` count, from which tokens/sec is derived.
+    Spans nest: the CUDA peak of a span includes its children's. With `capture` and
+    `Config.profiler` set, the stage also runs under cProfile or torch.profiler and the
+    path of the capture is recorded.
+    """
+    record: Dict[str, Any] = {"name": name, "depth": len(_OPEN)}
+    cuda = _cuda()
+    if _OPEN:
+        _update_cuda_peak(_OPEN[-1])
+    if cuda is not None:
+        cuda.reset_peak_memory_stats()
+    _OPEN.append(record)
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        if capture:
+            with _capture(name) as path:
+                if path is not None:
+                    record["capture"] = str(path)
+                yield record
+        else:
+            yield record
+    finally:
+        record["wall_seconds"] = time.perf_counter() - wall
+        record["cpu_seconds"] = time.process_time() - cpu
+        record["peak_rss_mb"] = _peak_rss_mb()
+        _update_cuda_peak(record)
+        if "tokens" in record and record["wall_seconds"] > 0:
+            record["tokens_per_second"] = record["tokens"] / record["wall_seconds"]
+
+        _OPEN.pop()
+        if _OPEN and "cuda_peak_mb" in record:
+            _OPEN[-1]["cuda_peak_mb"] = max(
+                _OPEN[-1].get("cuda_peak_mb", 0.0), record["cuda_peak_mb"]
+            )
+        _SPANS.append(record)
+
+
+def collect() -> List[Dict[str, Any]]:
+    """Returns the spans finished since the last call, in order of completion"""
+    spans = list(_SPANS)
+    _SPANS.clear()
+    return spans
+
+
+def profile_table(paths: List[Path]) -> List[Dict[str, Any]]:
+    """One row per profile file: wall seconds of each top-level stage, tokens/sec of the
+    training and prediction spans and the peak memory.
+    """
+    rows = []
+    for path in paths:
+        with open(path, "r") as f:
+            spans = json.load(f)["spans"]
+
+        row: Dict[str, Any] = {"path": path.name[: -len(PROFILE_SUFFIX)]}
+        for record in spans:
+            if record["depth"] == 0:
+                key = f"{record['name']}_s"
+                row[key] = row.get(key, 0.0) + record["wall_seconds"]
+            if "tokens_per_second" in record:
+                row[f"{record['name']} tokens/s"] = record["tokens_per_second"]
+        row["peak_rss_mb"] = max(x["peak_rss_mb"] for x in spans)
+        cuda_peaks = [x["cuda_peak_mb"] for x in spans if "cuda_peak_mb" in x]
+        if cuda_peaks:
+            row["cuda_peak_mb"] = max(cuda_peaks)
+        rows.append(row)
+    return rows
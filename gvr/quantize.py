@@ -0,0 +1,126 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import torch
+from datasets import Dataset
+from sklearn.metrics import classification_report
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from .configs import Config
+from .experiments import experiment_cell, save_result
+from .inference import QUANTIZED_WEIGHTS, Predictor
+
+
+def directory_size_mb(path: Path) -> float:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) / 2**20
+
+
+def quantize_checkpoint(model_path: Path) -> Path:
+    """Applies dynamic int8 quantization to the linear layers of a finetuned checkpoint.
+
+    The quantized weights are saved with the config and tokenizer files in a sibling
+    '{model_path}-int8' directory, which `Predictor` loads like any other checkpoint.
+    """
+    output_path = model_path.with_name(f"{model_path.name}-int8")
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    model = AutoModelForSequenceClassification.from_pretrained(
+        str(model_path), torch_dtype=torch.float32
+    )
+    quantized = torch.quantization.quantize_dynamic(
+        model.eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    torch.save(quantized.state_dict(), output_path / QUANTIZED_WEIGHTS)
+    model.config.save_pretrained(str(output_path))
+    AutoTokenizer.from_pretrained(str(model_path)).save_pretrained(str(output_path))
+
+    return output_path
+
+
+def benchmark_predictor(predictor: Predictor, data: Dataset) -> Dict[str, Any]:
+    texts = data["text"]
+    # Fill the tokenization cache with the whole test set, so both predictors time
+    # cache hits instead of the first one paying the misses of the second
+    if predictor.cache is not None:
+        predictor.cache.encode(texts)
+    # Warm-up run so lazy initialization is not timed
+    predictor.predict(texts[: min(len(texts), 32)])
+
+    predictor.num_batches = 0
+    start = time.perf_counter()
+    labels, _ = predictor.predict(texts)
+    elapsed = time.perf_counter() - start
+
+    report = classification_report(
+        y_true=data["label"], y_pred=labels, output_dict=True
+    )
+    return {
+        "accuracy": report["accuracy"],
+        "macro avg-f1-score": report["macro avg"]["f1-score"],
+        "seconds": elapsed,
+        "ms_per_batch": 1000 * elapsed / max(predictor.num_batches, 1),
+        "texts_per_second": len(texts) / elapsed,
+        "report": report,
+    }
+
+
+def quantize_and_evaluate(
+    task: str,
+    language: str,
+    family: str,
+    model: str,
+    train_label: Optional[str] = None,
+) -> None:
+    """Quantizes the checkpoint of a grid cell and compares it with the original on the
+    cell's test sets, on CPU. Reports are written to results/quantization/.
+    """
+    name, _, test_sets = experiment_cell(task, language, family, model, train_label)
+    model_path = Path.cwd() / "checkpoints" / name
+    quantized_path = quantize_checkpoint(model_path)
+
+    device = torch.device("cpu")
+    predictors = {
+        "fp32": Predictor(model_path, device=device),
+        "int8": Predictor(quantized_path, device=device),
+    }
+    sizes = {
+        "fp32": directory_size_mb(model_path),
+        "int8": directory_size_mb(quantized_path),
+    }
+
+    for test_name, test in test_sets.items():
+        result: Dict[str, Any] = {}
+        for precision, predictor in predictors.items():
+            result[precision] = benchmark_predictor(predictor, test)
+            result[precision]["size_mb"] = sizes[precision]
+
+        result["delta"] = {
+            key: result["int8"][key] - result["fp32"][key]
+            for key in ["accuracy", "macro avg-f1-score"]
+        }
+        result["ratio"] = {
+            key: result["int8"][key] / result["fp32"][key]
+            for key in ["size_mb", "ms_per_batch"]
+        }
+        result["max_tokens"] = Config.inference_max_tokens
+
+        path = Path.cwd() / "results" / "quantization" / test_name
+        save_result(result, path.parent, path.name)
+        print(json.dumps({k: result[k] for k in ["delta", "ratio"]}, indent=4))
@@ -0,0 +1,258 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from .configs import Config, config_snapshot, fingerprint
+from .profiling import PROFILE_SUFFIX
+
+INDEX_FILENAME = "index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    task TEXT NOT NULL,
+    family TEXT NOT NULL,
+    language TEXT NOT NULL,
+    model TEXT NOT NULL,
+    mode TEXT,
+    train_label TEXT,
+    test_label TEXT,
+    seed INTEGER,
+    config_hash TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    UNIQUE (path, config_hash)
+);
+CREATE INDEX IF NOT EXISTS runs_cell ON runs (task, family, language);
+CREATE INDEX IF NOT EXISTS runs_path ON runs (path, created);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+RUN_COLUMNS = [
+    "path",
+    "task",
+    "family",
+    "language",
+    "model",
+    "mode",
+    "train_label",
+    "test_label",
+    "seed",
+    "config_hash",
+    "created",
+]
+
+
+def index_path() -> Path:
+    return Path.cwd() / "results" / INDEX_FILENAME
+
+
+def connect(path: Optional[Path] = None) -> sqlite3.Connection:
+    """Opens the results index, creating it if needed.
+
+    WAL mode and a generous timeout let run-grid workers append concurrently.
+    """
+    path = index_path() if path is None else path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def flatten_result(result: Dict[str, Any]) -> List[Tuple[str, float]]:
+    """Metrics of a `classification_report` as (name, value), e.g. 'macro avg-f1-score'"""
+    metrics = []
+    for key, value in result.items():
+        if isinstance(value, dict):
+            metrics.extend((f"{key}-{inner}", v) for inner, v in value.items())
+        else:
+            metrics.append((key, value))
+    return metrics
+
+
+def run_config_hash(entry: Dict[str, Any]) -> str:
+    """Identifies the configuration a result was produced with"""
+    return fingerprint(entry, config_snapshot(), Config.model2batchsize)
+
+
+def add_run(
+    conn: sqlite3.Connection,
+    path: str,
+    entry: Dict[str, Any],
+    result: Dict[str, Any],
+    config_hash: str = "",
+    created: Optional[float] = None,
+) -> None:
+    """Adds a result to the index, replacing the one with the same path and config hash.
+
+    `path` is the result file relative to results/, without extension. `entry` holds the
+    task, family, language, model and optionally mode, train and test label.
+    """
+    row = {
+        "path": path,
+        "mode": None,
+        "train_label": None,
+        "test_label": None,
+        "seed": Config.SEED,
+        **entry,
+        "config_hash": config_hash,
+        "created": time.time() if created is None else created,
+    }
+    with conn:
+        conn.execute(
+            f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(RUN_COLUMNS))}) "
+            "ON CONFLICT (path, config_hash) DO UPDATE SET "
+            + ", ".join(f"{c} = excluded.{c}" for c in RUN_COLUMNS[1:]),
+            [row[c] for c in RUN_COLUMNS],
+        )
+        (run_id,) = conn.execute(
+            "SELECT id FROM runs WHERE path = ? AND config_hash = ?",
+            (path, config_hash),
+        ).fetchone()
+        conn.execute("DELETE FROM metrics WHERE run_id = ?", (run_id,))
+        conn.executemany(
+            "INSERT INTO metrics (run_id, position, name, value) VALUES (?, ?, ?, ?)",
+            [
+                (run_id, position, name, value)
+                for position, (name, value) in enumerate(flatten_result(result))
+            ],
+        )
+
+
+def parse_result_path(path: str) -> Optional[Dict[str, Any]]:
+    """Recovers the index entry of a result file from its path relative to results/,
+    for files written before the index existed.
+    """
+    parts = path.split("/")
+    if len(parts) != 4 or parts[0] not in ["model_family", "detection_transfer"]:
+        return None
+    task, family, language, name = parts
+    entry: Dict[str, Any] = {"task": task, "family": family, "language": language}
+    if task == "detection_transfer":
+        model, _, labels = name.rpartition("_")
+        entry["train_label"], _, entry["test_label"] = labels.partition("--")
+    else:
+        model = name
+    entry["model"] = model
+    entry["mode"] = "probe" if model.endswith("-probe") else "finetune"
+    return entry
+
+
+def backfill(base_path: Path) -> int:
+    """Indexes the result files under `base_path` whose path is not in the index yet.
+
+    Their config hash is unknown and left empty. The backfill is recorded in the `meta`
+    table (see `backfilled`). Returns the number of added results.
+    """
+    added = 0
+    with closing(connect()) as conn:
+        known = {path for (path,) in conn.execute("SELECT DISTINCT path FROM runs")}
+        for result_path in sorted(base_path.rglob("*.json")):
+            if result_path.name.endswith(PROFILE_SUFFIX):
+                continue
+            path = str(result_path.relative_to(base_path))[: -len(".json")]
+            entry = parse_result_path(path)
+            if path in known or entry is None:
+                continue
+            with open(result_path, "r") as f:
+                result = json.load(f)
+            add_run(conn, path, entry, result, created=result_path.stat().st_mtime)
+            added += 1
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', ?)",
+                (str(time.time()),),
+            )
+    return added
+
+
+def backfilled() -> bool:
+    """Whether the result files written before the index existed were added to it.
+
+    Experiments create the index with their own run, so its existence doesn't tell.
+    """
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'backfilled'").fetchone()
+    return row is not None
+
+
+def query_runs(
+    tasks: Optional[Sequence[str]] = None,
+    families: Optional[Sequence[str]] = None,
+    languages: Optional[Sequence[str]] = None,
+    models: Optional[Sequence[str]] = None,
+    latest: bool = True,
+) -> Tuple[pd.DataFrame, List[str]]:
+    """Runs matching the filters, one row per run with a column per metric.
+
+    With `latest`, only the most recent run of each result path is kept. Returns the
+    runs and the metric names in the order of the reports.
+    """
+    conditions = []
+    parameters: List[Any] = []
+    for column, values in [
+        ("task", tasks),
+        ("family", families),
+        ("language", languages),
+        ("model", models),
+    ]:
+        if values:
+            conditions.append(f"r.{column} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+    if latest:
+        conditions.append(
+            "r.created = (SELECT MAX(created) FROM runs WHERE path = r.path)"
+        )
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with closing(connect()) as conn:
+        runs = pd.read_sql_query(
+            f"SELECT r.id, {', '.join('r.' + c for c in RUN_COLUMNS)} FROM runs r "
+            f"{where} ORDER BY r.path, r.created",
+            conn,
+            params=parameters,
+        )
+        metrics = pd.read_sql_query(
+            "SELECT m.run_id, m.position, m.name, m.value FROM metrics m "
+            f"JOIN runs r ON r.id = m.run_id {where}",
+            conn,
+            params=parameters,
+        )
+
+    positions = metrics.groupby("name")["position"].min()
+    names = positions.sort_values(kind="stable").index.tolist()
+    wide = metrics.pivot(index="run_id", columns="name", values="value")
+    runs = runs.join(wide.reindex(columns=names), on="id").drop(columns="id")
+    return runs, names
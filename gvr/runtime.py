@@ -0,0 +1,107 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional
+
+import torch
+
+from .configs import Config
+from .distributed import world_size
+
+PRECISIONS = ["fp32", "fp16", "bf16"]
+
+
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bf16 instructions (AVX512-BF16 or AMX)"""
+    cpuinfo = Path("/proc/cpuinfo")
+    if not cpuinfo.exists():
+        return False
+    flags = cpuinfo.read_text()
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+class TrainingProfile(NamedTuple):
+    """Device-dependent training settings"""
+
+    precision: str
+    intra_op_threads: int
+    inter_op_threads: int
+    dataloader_workers: int
+    pin_memory: bool
+    compile: bool
+
+    def apply(self) -> None:
+        """Sets the process-wide thread counts of the profile"""
+        torch.set_num_threads(self.intra_op_threads)
+        try:
+            torch.set_num_interop_threads(self.inter_op_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work started
+            pass
+
+    def training_arguments(self, device: torch.device) -> Dict[str, Any]:
+        """Keyword arguments for `TrainingArguments`"""
+        return {
+            "fp16": self.precision == "fp16",
+            "bf16": self.precision == "bf16",
+            "no_cuda": device.type == "cpu",
+            "dataloader_num_workers": self.dataloader_workers,
+            "dataloader_pin_memory": self.pin_memory,
+            "torch_compile": self.compile,
+            # Data parallel CPU workers communicate over gloo
+            "xpu_backend": "gloo" if device.type == "cpu" and world_size() > 1 else None,
+        }
+
+
+def training_profile(device: Optional[torch.device] = None) -> TrainingProfile:
+    """Chooses the training profile for `device`, unless overridden in `Config`.
+
+    On GPU: fp16 (as in the paper experiments) with pinned memory. On CPU: bf16 autocast
+    if the CPU supports it, fp32 otherwise, with as many intra-op threads as the process
+    may use and no pinned memory.
+    """
+    device = Config.device if device is None else device
+    on_cuda = device.type == "cuda"
+
+    if Config.precision is not None:
+        precision = Config.precision
+    elif on_cuda:
+        precision = "fp16"
+    else:
+        precision = "bf16" if cpu_supports_bf16() else "fp32"
+    if precision not in PRECISIONS:
+        raise RuntimeError(f"Precision must be one of {PRECISIONS}.")
+    if precision == "fp16" and not on_cuda:
+        raise RuntimeError("fp16 training needs a GPU, use bf16 or fp32 on CPU.")
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else 1
+    intra_op_threads = Config.intra_op_threads or torch.get_num_threads()
+    inter_op_threads = Config.inter_op_threads or (1 if not on_cuda else 2)
+    if Config.dataloader_workers is not None:
+        dataloader_workers = Config.dataloader_workers
+    else:
+        # On CPU, workers compete with the intra-op threads for the same cores
+        dataloader_workers = 2 if on_cuda or cores > intra_op_threads + 2 else 0
+
+    return TrainingProfile(
+        precision=precision,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+        dataloader_workers=dataloader_workers,
+        pin_memory=on_cuda,
+        compile=Config.torch_compile,
+    )
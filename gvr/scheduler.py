@@ -0,0 +1,218 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import torch
+
+from .configs import Config, config_snapshot, fingerprint
+from .experiments import (
+    detection_transference_experiment,
+    model_family_experiment,
+    model_key,
+    transference_labels,
+)
+
+EXPERIMENTS = ["model_family", "detection_transfer"]
+
+
+class Job(NamedTuple):
+    """A single cell of the experiment grid: one model trained on one train set"""
+
+    experiment: str
+    family: str
+    language: str
+    model: str
+    train_label: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        parts = [self.experiment, self.family, self.language, model_key(self.model)]
+        if self.train_label is not None:
+            parts.append(self.train_label)
+        return "/".join(parts)
+
+    def result_paths(self) -> List[Path]:
+        path = Path.cwd() / "results" / self.experiment / self.family / self.language
+        if self.experiment == "model_family":
+            return [path / f"{model_key(self.model)}.json"]
+        return [
+            path / f"{model_key(self.model)}_{self.train_label}--{test_label}.json"
+            for test_label in transference_labels(self.family)
+        ]
+
+    def config_hash(self) -> str:
+        return fingerprint(
+            list(self),
+            Config.model2batchsize.get(self.model),
+            config_snapshot(),
+        )
+
+    def run(self) -> float:
+        """Runs the job and returns its wall time in seconds"""
+        start = time.perf_counter()
+        if self.experiment == "model_family":
+            model_family_experiment(self.language, self.family, models=[self.model])
+        else:
+            detection_transference_experiment(
+                self.language,
+                self.family,
+                models=[self.model],
+                train_labels=[self.train_label],
+            )
+        return time.perf_counter() - start
+
+
+def expand_jobs(
+    experiments: List[str],
+    families: List[str],
+    languages: List[str],
+    models: Optional[List[str]] = None,
+) -> List[Job]:
+    """Expands (experiment, family, language, model, train_label) into jobs"""
+    jobs = []
+    for experiment in experiments:
+        if experiment not in EXPERIMENTS:
+            raise RuntimeError(f"Experiment must be one of {EXPERIMENTS}.")
+        for family in families:
+            for language in languages:
+                for model in Config.models[language]:
+                    if models and model not in models:
+                        continue
+                    if experiment == "model_family":
+                        jobs.append(Job(experiment, family, language, model))
+                    else:
+                        for train_label in transference_labels(family):
+                            jobs.append(
+                                Job(experiment, family, language, model, train_label)
+                            )
+    return jobs
+
+
+class Ledger:
+    """Append-only JSON lines file with the state transitions of each job.
+
+    Each line is a record with the job name, its state (running, done or failed), the
+    config hash of the job and, once finished, its wall time. The latest record of a job
+    is its current state.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def states(self) -> Dict[str, Dict[str, Any]]:
+        states: Dict[str, Dict[str, Any]] = {}
+        if not self.path.exists():
+            return states
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    states[record["job"]] = record
+        return states
+
+    def record(self, job: Job, state: str, **fields: Any) -> None:
+        record = {
+            "job": job.name,
+            "state": state,
+            "config_hash": job.config_hash(),
+            "time": time.time(),
+            "pid": os.getpid(),
+            **fields,
+        }
+        # Single-line appends are atomic, so workers and the scheduler can share the file
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def is_done(self, job: Job, states: Dict[str, Dict[str, Any]]) -> bool:
+        record = states.get(job.name)
+        return (
+            record is not None
+            and record["state"] == "done"
+            and record["config_hash"] == job.config_hash()
+            and all(path.exists() for path in job.result_paths())
+        )
+
+
+def _init_worker(threads: int, overrides: Dict[str, Any]) -> None:
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "TOKENIZERS_PARALLELISM"]:
+        os.environ[var] = "false" if var == "TOKENIZERS_PARALLELISM" else str(threads)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    for key, value in overrides.items():
+        setattr(Config, key, value)
+
+
+def _run_job(job: Job, ledger_path: Path) -> float:
+    Ledger(ledger_path).record(job, "running")
+    return job.run()
+
+
+def run_grid(
+    jobs: List[Job],
+    ledger_path: Path,
+    workers: int = 1,
+    threads: Optional[int] = None,
+    overrides: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Runs `jobs` on a pool of `workers` processes with `threads` CPU threads each.
+
+    Jobs already done with the same config hash, and whose result JSONs exist, are
+    skipped, so an interrupted grid can be resumed by running it again. `overrides` are
+    `Config` attributes set in every worker, they must already be set in this process.
+    """
+    ledger = Ledger(ledger_path)
+    states = ledger.states()
+
+    pending = []
+    for job in jobs:
+        if ledger.is_done(job, states):
+            print(f"Skipping {job.name}: already done.")
+        else:
+            pending.append(job)
+
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+    print(f"Running {len(pending)} jobs on {workers} workers with {threads} threads each.")
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(threads, overrides or {}),
+    ) as pool:
+        futures = {pool.submit(_run_job, job, ledger_path): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                wall_time = future.result()
+            except Exception as e:
+                ledger.record(job, "failed", error=repr(e))
+                print(f"Failed {job.name}: {e!r}")
+            else:
+                ledger.record(job, "done", wall_time=wall_time)
+                print(f"Done {job.name} in {wall_time:.1f}s")
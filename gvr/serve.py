@@ -0,0 +1,287 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import json
+import signal
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .inference import Predictor
+
+# Latencies kept to compute percentiles in /metrics
+LATENCY_WINDOW = 10000
+
+
+class MicroBatcher:
+    """Gathers concurrent requests for one model into micro-batches.
+
+    A batch is closed when it holds `max_batch_size` texts or `max_wait_ms` after its
+    first text arrived, whichever comes first, and then runs on the worker thread.
+    """
+
+    def __init__(
+        self,
+        predictor: Predictor,
+        executor: ThreadPoolExecutor,
+        max_batch_size: int,
+        max_wait_ms: float,
+    ):
+        self.predictor = predictor
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: "asyncio.Queue[Optional[Tuple[str, asyncio.Future]]]" = (
+            asyncio.Queue()
+        )
+        self.batch_sizes: Counter = Counter()
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def predict(self, texts: List[str]) -> List[Dict[str, Any]]:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.queue.put_nowait((text, future))
+            futures.append(future)
+
+        outputs = await asyncio.gather(*futures)
+        self.requests += 1
+        self.latencies.append(time.perf_counter() - start)
+        return outputs
+
+    async def _next_batch(self) -> Tuple[List[Tuple[str, asyncio.Future]], bool]:
+        """Returns the next batch and whether the batcher was asked to stop"""
+        loop = asyncio.get_running_loop()
+        item = await self.queue.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            batch, stop = await self._next_batch()
+            if not batch:
+                continue
+
+            self.batch_sizes[len(batch)] += 1
+            texts = [text for text, _ in batch]
+            try:
+                labels, probs = await loop.run_in_executor(
+                    self.executor, self.predictor.predict, texts
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), label, prob in zip(batch, labels, probs.tolist()):
+                future.set_result(
+                    {
+                        "label": label,
+                        "probabilities": dict(zip(self.predictor.labels, prob)),
+                    }
+                )
+
+    async def stop(self) -> None:
+        """Serves what is already queued and stops"""
+        self.queue.put_nowait(None)
+        await self.task
+
+    def metrics(self) -> Dict[str, Any]:
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests": self.requests,
+            "batches": sum(self.batch_sizes.values()),
+            "batch_size_histogram": {
+                str(size): count for size, count in sorted(self.batch_sizes.items())
+            },
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            },
+        }
+
+
+class DetectorServer:
+    """Minimal asyncio HTTP/1.1 server routing requests to several detectors.
+
+    Routes:
+        POST /predict/{model}  {"texts": [...]} or {"text": "..."}
+        GET  /metrics          queue depth, batch size histogram, latency percentiles and
+                               number of internal errors
+        GET  /health
+    """
+
+    def __init__(
+        self,
+        models: Dict[str, Path],
+        max_batch_size: int = 64,
+        max_wait_ms: float = 10.0,
+        max_tokens: Optional[int] = None,
+        threads: int = 1,
+    ):
+        self.model_paths = models
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_tokens = max_tokens
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.batchers: Dict[str, MicroBatcher] = {}
+        self.started = time.time()
+        self.errors = 0
+
+    async def _handle_request(
+        self, method: str, path: str, body: bytes
+    ) -> Tuple[int, Dict[str, Any]]:
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "models": list(self.batchers.keys())}
+
+        if method == "GET" and path == "/metrics":
+            return 200, {
+                "uptime_seconds": time.time() - self.started,
+                "errors": self.errors,
+                "models": {
+                    name: batcher.metrics() for name, batcher in self.batchers.items()
+                },
+            }
+
+        if method == "POST" and path.startswith("/predict/"):
+            name = path[len("/predict/") :]
+            if name not in self.batchers:
+                return 404, {"error": f"Unknown model '{name}'."}
+            try:
+                request = json.loads(body or b"{}")
+                texts = request["texts"] if "texts" in request else [request["text"]]
+                texts = [str(text) for text in texts]
+            except (ValueError, KeyError, TypeError):
+                return 400, {"error": "Expected a JSON body with 'text' or 'texts'."}
+            return 200, {"predictions": await self.batchers[name].predict(texts)}
+
+        return 404, {"error": f"No route for {method} {path}."}
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, response = await self._handle_request(method, path, body)
+                except Exception as e:
+                    # Predictor or batcher failure, the connection stays usable
+                    self.errors += 1
+                    status, response = 500, {"error": f"{type(e).__name__}: {e}"}
+
+                payload = json.dumps(response).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        # Detectors are served on CPU only
+        device = torch.device("cpu")
+        for name, path in self.model_paths.items():
+            predictor = Predictor(
+                path, device=device, max_tokens=self.max_tokens, cache=False
+            )
+            self.batchers[name] = MicroBatcher(
+                predictor, self.executor, self.max_batch_size, self.max_wait_ms
+            )
+
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        print(f"Serving {list(self.batchers.keys())} on http://{host}:{port}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stop.set)
+
+        async with server:
+            await stop.wait()
+            # Graceful shutdown: stop accepting connections, then drain the queues
+            print("Shutting down...")
+            server.close()
+            await server.wait_closed()
+            for batcher in self.batchers.values():
+                await batcher.stop()
+            self.executor.shutdown(wait=True)
+
+
+def serve(
+    models: Dict[str, Path],
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 64,
+    max_wait_ms: float = 10.0,
+    max_tokens: Optional[int] = None,
+    threads: int = 1,
+) -> None:
+    server = DetectorServer(models, max_batch_size, max_wait_ms, max_tokens, threads)
+    asyncio.run(server.serve(host, port))
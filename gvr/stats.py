@@ -0,0 +1,142 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .configs import Config, fingerprint
+from .predictions import load_predictions
+
+METRICS = ["macro avg-f1-score", "macro avg-precision", "macro avg-recall", "accuracy"]
+
+
+def bootstrap_confusions(
+    codes: np.ndarray,
+    n_codes: int,
+    n_resamples: int,
+    seed: int = Config.SEED,
+    chunk_size: int = 128,
+) -> np.ndarray:
+    """Bootstraps the counts of (true label, predicted label) pairs of several models.
+
+    `codes` is an (n_models, n_rows) matrix with the pair code (true * n_labels + pred)
+    of each row, all models scored on the same rows. Every model sees the same resamples,
+    so differences between models are paired. Each chunk of resamples is one index matrix,
+    turned into per-row counts that are multiplied with the one-hot codes.
+    Returns an (n_models, n_resamples, n_codes) array.
+    """
+    n_models, n_rows = codes.shape
+    rng = np.random.default_rng(seed)
+    one_hot = np.zeros((n_models, n_rows, n_codes), dtype=np.float32)
+    one_hot[np.arange(n_models)[:, None], np.arange(n_rows)[None, :], codes] = 1
+
+    counts = np.empty((n_models, n_resamples, n_codes), dtype=np.float32)
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+        indices = rng.integers(0, n_rows, size=(size, n_rows))
+        offsets = (np.arange(size)[:, None] * n_rows + indices).ravel()
+        weights = np.bincount(offsets, minlength=size * n_rows).astype(np.float32)
+        weights = weights.reshape(size, n_rows)
+        counts[:, start : start + size] = weights @ one_hot
+    return counts
+
+
+def confusion_metrics(counts: np.ndarray, n_labels: int) -> Dict[str, np.ndarray]:
+    """Accuracy and macro precision, recall and F1 (as in `classification_report`, with
+    0 for undefined values) of flattened confusion counts (..., n_labels * n_labels).
+    """
+    confusion = counts.reshape(*counts.shape[:-1], n_labels, n_labels)
+    true_positives = np.diagonal(confusion, axis1=-2, axis2=-1)
+    support = confusion.sum(axis=-1)
+    predicted = confusion.sum(axis=-2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.nan_to_num(true_positives / predicted)
+        recall = np.nan_to_num(true_positives / support)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+
+    # Labels absent from the resample and never predicted don't count in macro averages
+    present = (support + predicted) > 0
+    n_present = np.maximum(present.sum(axis=-1), 1)
+    return {
+        "macro avg-f1-score": (f1 * present).sum(axis=-1) / n_present,
+        "macro avg-precision": (precision * present).sum(axis=-1) / n_present,
+        "macro avg-recall": (recall * present).sum(axis=-1) / n_present,
+        "accuracy": true_positives.sum(axis=-1) / counts.sum(axis=-1),
+    }
+
+
+def paired_p_value(a: np.ndarray, b: np.ndarray) -> float:
+    """Two-sided paired bootstrap p-value of the difference between two metric samples"""
+    delta = a - b
+    return float(min(1.0, 2 * min(np.mean(delta <= 0), np.mean(delta >= 0))))
+
+
+def bootstrap_table(
+    prediction_paths: List[Path],
+    n_resamples: int,
+    level: float = 0.95,
+    seed: int = Config.SEED,
+) -> pd.DataFrame:
+    """Bootstrap confidence intervals for each prediction file, and paired p-values.
+
+    Files scored on the same test set (same rows in the same order) are bootstrapped
+    together. Each one gets the p-value of its macro F1 difference with the best model
+    of its test set. Rows follow `prediction_paths`, metrics are in percent.
+    """
+    frames = [load_predictions(path)[0] for path in prediction_paths]
+
+    groups: Dict[str, List[int]] = {}
+    for idx, df in enumerate(frames):
+        groups.setdefault(fingerprint(df["text_hash"].tolist()), []).append(idx)
+
+    table: List[Dict[str, Optional[float]]] = [{} for _ in frames]
+    alpha = 100 * (1 - level) / 2
+    for members in groups.values():
+        labels = sorted(
+            set().union(
+                *[set(frames[i]["label"]) | set(frames[i]["hyp_label"]) for i in members]
+            )
+        )
+        label2id = {label: idx for idx, label in enumerate(labels)}
+        codes = np.stack(
+            [
+                frames[i]["label"].map(label2id).to_numpy() * len(labels)
+                + frames[i]["hyp_label"].map(label2id).to_numpy()
+                for i in members
+            ]
+        )
+        n_codes = len(labels) ** 2
+        samples = confusion_metrics(
+            bootstrap_confusions(codes, n_codes, n_resamples, seed), len(labels)
+        )
+        observed = confusion_metrics(
+            np.stack([np.bincount(x, minlength=n_codes) for x in codes]), len(labels)
+        )
+
+        f1 = samples["macro avg-f1-score"]
+        best = int(np.argmax(observed["macro avg-f1-score"]))
+        for position, idx in enumerate(members):
+            for metric in METRICS:
+                low, high = np.percentile(samples[metric][position], [alpha, 100 - alpha])
+                table[idx][f"{metric}-low"] = 100 * low
+                table[idx][f"{metric}-high"] = 100 * high
+            table[idx]["p-value"] = (
+                None if position == best else paired_p_value(f1[best], f1[position])
+            )
+
+    return pd.DataFrame(table)
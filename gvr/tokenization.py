@@ -0,0 +1,193 @@
+# Copyright 2023 The Symanto Research Team Authors.
+#
+# Licensed under the CC BY-NC-SA 3.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://creativecommons.org/licenses/by-nc-sa/3.0/legalcode
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import fcntl
+import hashlib
+import json
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from datasets import Dataset, concatenate_datasets, load_from_disk
+from transformers import PreTrainedTokenizerBase
+
+from .configs import Config
+from .data import text_hash
+
+# Number of shards under COMPACT_SHARD_ROWS rows that are merged into one
+COMPACT_SHARDS = 32
+COMPACT_SHARD_ROWS = 50000
+
+
+def tokenizer_fingerprint(
+    tokenizer: PreTrainedTokenizerBase, max_length: Optional[int]
+) -> Dict[str, Any]:
+    """Describes everything that determines the output of `tokenizer` on a text.
+
+    Fast tokenizers are identified by the hash of their serialized pipeline, so a
+    checkpoint's copy of a tokenizer shares the entries of the hub tokenizer it came from.
+    """
+    if tokenizer.is_fast:
+        serialized = tokenizer.backend_tokenizer.to_str()
+        identity = hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+    else:
+        revision = tokenizer.init_kwargs.get("_commit_hash")
+        identity = f"{tokenizer.name_or_path}@{revision}"
+
+    return {
+        "tokenizer": identity,
+        "class": type(tokenizer).__name__,
+        "truncation": max_length is not None,
+        "max_length": max_length,
+    }
+
+
+class TokenizationCache:
+    """Persistent tokenization cache shared across models, experiments and runs.
+
+    Entries are keyed by the tokenizer fingerprint and the hash of each text. Each
+    fingerprint owns a directory under cache/tokenization/ with one Arrow shard per batch
+    of new texts, and shards are memory-mapped when loaded. Only shards written since the
+    last lookup are loaded, and small shards are compacted once they pile up. Texts
+    already in the cache never go through the tokenizer again.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        max_length: Optional[int] = Config.max_length,
+        cache_dir: Optional[Path] = None,
+    ):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+
+        fingerprint = tokenizer_fingerprint(tokenizer, max_length)
+        digest = hashlib.sha1(
+            json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        if cache_dir is None:
+            cache_dir = Path.cwd() / Config.cache_dir / "tokenization"
+        self.path = cache_dir / digest
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        meta_path = self.path / "meta.json"
+        if not meta_path.exists():
+            with open(meta_path, "w") as f:
+                json.dump(
+                    {"name_or_path": tokenizer.name_or_path, **fingerprint}, f, indent=4
+                )
+
+        self._shards: Dict[str, Dataset] = {}
+        self._data: Optional[Dataset] = None
+        self._index: Dict[str, int] = {}
+        self._load()
+
+    @contextmanager
+    def _lock(self, operation: int) -> Iterator[None]:
+        # Readers hold a shared lock so compaction never deletes a shard being loaded
+        with open(self.path / ".lock", "w") as lock:
+            fcntl.flock(lock, operation)
+            yield
+
+    def _load(self) -> None:
+        """Loads the shards written since the last call, by this or other processes"""
+        with self._lock(fcntl.LOCK_SH):
+            new = {
+                path.name: load_from_disk(str(path))
+                for path in sorted(self.path.glob("shard-*"))
+                if path.name not in self._shards
+            }
+        if not new:
+            return
+
+        offset = 0 if self._data is None else len(self._data)
+        for shard in new.values():
+            for i, h in enumerate(shard["text_hash"]):
+                # Compacted shards repeat entries that may already be indexed
+                self._index.setdefault(h, offset + i)
+            offset += len(shard)
+        self._shards.update(new)
+        loaded = [] if self._data is None else [self._data]
+        self._data = concatenate_datasets(loaded + list(new.values()))
+
+    def _write_shard(self, texts: Dict[str, str]) -> None:
+        encodings = self.tokenizer(
+            list(texts.values()),
+            truncation=self.max_length is not None,
+            max_length=self.max_length,
+        )
+        shard = Dataset.from_dict({"text_hash": list(texts.keys()), **encodings})
+        self._save_shard(shard)
+
+    def _save_shard(self, shard: Dataset) -> None:
+        # Write to a temporary directory first so concurrent readers never see a
+        # partially written shard
+        name = f"shard-{uuid.uuid4().hex}"
+        tmp_path = self.path / f".tmp-{name}"
+        shard.save_to_disk(str(tmp_path))
+        tmp_path.rename(self.path / name)
+
+    def _compact(self) -> None:
+        """Merges the small shards into one once there are `COMPACT_SHARDS` of them"""
+        with self._lock(fcntl.LOCK_EX):
+            small = []
+            for path in sorted(self.path.glob("shard-*")):
+                shard = load_from_disk(str(path))
+                if len(shard) < COMPACT_SHARD_ROWS:
+                    small.append((path, shard))
+            if len(small) < COMPACT_SHARDS:
+                return
+
+            merged = concatenate_datasets([shard for _, shard in small])
+            self._save_shard(merged)
+            for path, _ in small:
+                shutil.rmtree(path)
+
+        # Start over from the compacted shards, loaded shards stay memory-mapped until
+        # they are released
+        self._shards, self._data, self._index = {}, None, {}
+        self._load()
+
+    def encode(self, texts: List[str]) -> Dataset:
+        """Returns the tokenized `texts`, in order, tokenizing only unseen texts."""
+        hashes = [text_hash(text) for text in texts]
+
+        missing: Dict[str, str] = {}
+        for h, text in zip(hashes, texts):
+            if h not in self._index and h not in missing:
+                missing[h] = text
+
+        self.hits += sum(1 for h in hashes if h in self._index)
+        self.misses += len(missing)
+
+        if missing:
+            self._write_shard(missing)
+            self._load()
+            small = [x for x in self._shards.values() if len(x) < COMPACT_SHARD_ROWS]
+            if len(small) >= COMPACT_SHARDS:
+                self._compact()
+
+        encoded = self._data.select([self._index[h] for h in hashes])
+        return encoded.remove_columns("text_hash")
+
+    def __repr__(self) -> str:
+        return (
+            f"TokenizationCache(path={self.path}, entries={len(self._index)}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
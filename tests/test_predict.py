@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pandas as pd
+
+from gvr.predict import read_chunks
+
+
+def test_read_chunks_parquet(tmp_path: Path):
+    path = tmp_path / "input.parquet"
+    pd.DataFrame(
+        {"id": [10, 11, 12], "text": ["a", None, "c"], "other": [1, 2, 3]}
+    ).to_parquet(path)
+
+    chunks = list(read_chunks(path, chunk_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    df = pd.concat(chunks, ignore_index=True)
+    assert df.columns.tolist() == ["id", "text"]
+    assert df["id"].tolist() == [10, 11, 12]
+    assert df["text"].tolist() == ["a", "", "c"]
+
+
+def test_read_chunks_parquet_without_ids(tmp_path: Path):
+    path = tmp_path / "input.parquet"
+    pd.DataFrame({"text": ["a", "b", "c"]}).to_parquet(path)
+
+    df = pd.concat(read_chunks(path, chunk_size=2), ignore_index=True)
+
+    assert df["id"].tolist() == [0, 1, 2]